@@ -0,0 +1,434 @@
+import heapq
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import socket
+import threading
+import time
+import urllib.request
+
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class WebhookSink:
+    """
+    POSTs each alert as JSON to `url`.
+    """
+
+    def __init__(self, url: str, timeout: float = 5.0):
+        self.name = f"webhook:{url}"
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, alert: dict):
+        body = json.dumps(alert, default=str).encode("utf-8")
+        request = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            if response.status >= 300:
+                raise RuntimeError(f"webhook returned {response.status}")
+
+
+class SyslogSink:
+    """
+    Sends a one-line summary to syslog, e.g. address=("localhost", 514) or "/dev/log".
+
+    Writes to the socket itself rather than through SysLogHandler, whose
+    emit() swallows errors: a failed send raises, so the alert is retried
+    like any other sink's. UDP cannot tell a lost datagram; a refused port
+    only shows up on the next send. Use socktype=socket.SOCK_STREAM for a
+    TCP syslog server to get every failure.
+    """
+
+    def __init__(self, address="/dev/log", facility=logging.handlers.SysLogHandler.LOG_AUTH, socktype=None):
+        self.name = f"syslog:{address}"
+        self.address = address
+        self.facility = facility
+        self.socktype = socktype
+        self._sock = None
+
+    def _connect(self):
+        if isinstance(self.address, str):
+            # Local daemons listen on a datagram or a stream socket.
+            socktypes = [self.socktype] if self.socktype else [socket.SOCK_DGRAM, socket.SOCK_STREAM]
+            family, addr = socket.AF_UNIX, self.address
+        else:
+            socktypes = [self.socktype or socket.SOCK_DGRAM]
+            family, _, _, _, addr = socket.getaddrinfo(*self.address, 0, socktypes[0])[0]
+        for i, socktype in enumerate(socktypes, 1):
+            sock = socket.socket(family, socktype)
+            try:
+                # Connected UDP sockets report a refusal from the host on a later send.
+                sock.connect(addr)
+                return sock
+            except OSError:
+                sock.close()
+                if i == len(socktypes):
+                    raise
+
+    def send(self, alert: dict):
+        severity = (logging.handlers.SysLogHandler.LOG_WARNING if alert["decision"] == "Challenge"
+                    else logging.handlers.SysLogHandler.LOG_CRIT)
+        message = f"<{self.facility << 3 | severity}>GART {json.dumps(alert, default=str)}\000"
+        if self._sock is None:
+            self._sock = self._connect()
+        try:
+            self._sock.sendall(message.encode("utf-8"))
+        except OSError:
+            # Reconnect on the retry, e.g. after the syslog daemon restarted.
+            self._sock.close()
+            self._sock = None
+            raise
+
+
+class FileSink:
+    """
+    Appends alerts as JSON lines.
+    """
+
+    def __init__(self, path: str):
+        self.name = f"file:{path}"
+        self.path = path
+
+    def send(self, alert: dict):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(alert, default=str) + "\n")
+
+
+class MemorySink:
+    """
+    Local stand-in for tests and demos: keeps alerts in a list. Can be made
+    to fail its first `fail_first` sends or to be slow, to exercise retries
+    and check that scoring does not wait for it.
+    """
+
+    def __init__(self, fail_first: int = 0, delay: float = 0.0):
+        self.name = "memory"
+        self.alerts = []
+        self.fail_first = fail_first
+        self.delay = delay
+        self.calls = 0
+
+    def send(self, alert: dict):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if self.calls <= self.fail_first:
+            raise RuntimeError("simulated sink failure")
+        self.alerts.append(alert)
+
+
+class _SinkWorker:
+    """
+    Delivers alerts to one sink from its own thread, so a slow or failing
+    sink (e.g. a webhook waiting on its timeout) does not hold up grouping
+    or the other sinks. Keeps the sink's rate-limit tokens and its retry
+    schedule.
+    """
+
+    def __init__(self, sink, rate_per_minute: int, max_retries: int, backoff_base: float,
+                 backoff_max: float, max_queue: int):
+        self.sink = sink
+        self.rate_per_minute = rate_per_minute
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._pending = []
+        self._seq = itertools.count()
+        self._tokens = float(rate_per_minute)
+        self._refilled = time.monotonic()
+
+        self.dropped = 0
+        self.sent = 0
+        self.deferred = 0
+        self.retries = 0
+        self.failed = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"gart-alerts-{self.sink.name}", daemon=True)
+            self._thread.start()
+        return self
+
+    def put(self, alert: dict):
+        try:
+            self._queue.put_nowait(alert)
+        except queue.Full:
+            self.dropped += 1
+            logger.error("Alert queue of %s is full, dropped alert for %s", self.sink.name, alert.get("group"))
+
+    def stop(self, deadline: float):
+        """
+        Try to deliver what is queued or pending before `deadline`
+        (time.monotonic()), then stop the thread.
+        """
+        if self._thread is None:
+            return
+        self._queue.put((_STOP, deadline))
+
+    def join(self, deadline: float):
+        if self._thread is not None:
+            self._thread.join(max(deadline - time.monotonic(), 0) + 1)
+            self._thread = None
+
+    def pending(self) -> int:
+        return self._queue.qsize() + len(self._pending)
+
+    def metrics(self) -> dict:
+        return {
+            "dropped": self.dropped,
+            "sent": self.sent,
+            "deferred": self.deferred,
+            "retries": self.retries,
+            "failed": self.failed,
+            "pending": self.pending(),
+        }
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            wake = now + 1.0
+            if self._pending:
+                wake = min(wake, self._pending[0][0])
+            try:
+                item = self._queue.get(timeout=max(wake - now, 0))
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, tuple) and item and item[0] is _STOP:
+                self._drain(deadline=item[1])
+                return
+            if item is not None:
+                self._schedule(item)
+            self._deliver_due()
+
+    def _schedule(self, alert: dict):
+        heapq.heappush(self._pending, (time.monotonic(), next(self._seq), alert, 0))
+
+    def _take_token(self) -> bool:
+        now = time.monotonic()
+        refill = (now - self._refilled) * self.rate_per_minute / 60.0
+        self._refilled = now
+        self._tokens = min(float(self.rate_per_minute), self._tokens + refill)
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return True
+        return False
+
+    def _deliver_due(self):
+        now = time.monotonic()
+        while self._pending and self._pending[0][0] <= now:
+            _, _, alert, attempt = heapq.heappop(self._pending)
+
+            if not self._take_token():
+                self.deferred += 1
+                retry_at = now + 60.0 / max(self.rate_per_minute, 1)
+                heapq.heappush(self._pending, (retry_at, next(self._seq), alert, attempt))
+                continue
+
+            try:
+                self.sink.send(alert)
+                self.sent += 1
+            except Exception as e:
+                if attempt + 1 > self.max_retries:
+                    self.failed += 1
+                    logger.error("Giving up on alert to %s after %d attempts: %s", self.sink.name, attempt + 1, e)
+                    continue
+                self.retries += 1
+                delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+                heapq.heappush(self._pending, (time.monotonic() + delay, next(self._seq), alert, attempt + 1))
+            # A slow send may have taken a while; later entries are due by now.
+            now = time.monotonic()
+
+    def _drain(self, deadline: float):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if not (isinstance(item, tuple) and item and item[0] is _STOP):
+                self._schedule(item)
+        while self._pending and time.monotonic() < deadline:
+            time.sleep(max(0.0, min(self._pending[0][0], deadline) - time.monotonic()))
+            self._deliver_due()
+        if self._pending:
+            logger.warning("%d alert deliveries to %s still pending at shutdown", len(self._pending), self.sink.name)
+
+
+class AlertDispatcher:
+    """
+    Fans Block / Challenge events out to alert sinks from background threads.
+
+    `submit()` never blocks: events go into a bounded queue and are dropped
+    (and counted) if it is full. The dispatcher thread:
+      - groups events with the same decision and `group_by` value (user_id
+        or country) that arrive within `window` seconds into one alert,
+      - suppresses an alert if the same group already alerted within
+        `dedup_seconds` (the suppressed event count is carried into the
+        next alert for that group),
+      - hands each alert to every sink's own delivery thread.
+    Each sink's thread limits it to `rate_per_minute` alerts, deferring the
+    rest, and retries failed sends with exponential backoff up to
+    `max_retries`, so a slow webhook only delays its own alerts.
+    """
+
+    def __init__(self, sinks, decisions=("Block", "Challenge"), group_by: str = "user_id",
+                 window: float = 5.0, dedup_seconds: float = 300.0, rate_per_minute: int = 30,
+                 max_retries: int = 5, backoff_base: float = 0.5, backoff_max: float = 60.0,
+                 max_queue: int = 10000):
+        self.sinks = list(sinks)
+        self.decisions = set(decisions)
+        self.group_by = group_by
+        self.window = window
+        self.dedup_seconds = dedup_seconds
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._groups = {}
+        self._last_alert = {}
+        self._suppressed = {}
+        self._workers = [
+            _SinkWorker(sink, rate_per_minute, max_retries, backoff_base, backoff_max, max_queue)
+            for sink in self.sinks
+        ]
+
+        self.received = 0
+        self.dropped = 0
+        self.alerts = 0
+        self.suppressed = 0
+
+    def start(self):
+        if self._thread is None:
+            for worker in self._workers:
+                worker.start()
+            self._thread = threading.Thread(target=self._run, name="gart-alerts", daemon=True)
+            self._thread.start()
+        return self
+
+    def submit(self, record: dict) -> bool:
+        if record.get("decision") not in self.decisions:
+            return False
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def stop(self, timeout: float = 10.0):
+        """
+        Close every open group and try to deliver what is pending before
+        `timeout` seconds. The sinks are drained in parallel.
+        """
+        if self._thread is None:
+            return
+        deadline = time.monotonic() + timeout
+        self._queue.put((_STOP, deadline))
+        self._thread.join(timeout + 1)
+        self._thread = None
+        for worker in self._workers:
+            worker.join(deadline)
+
+    def metrics(self) -> dict:
+        """
+        Dispatcher counters plus the delivery counters summed over sinks;
+        "sinks" has them per sink name.
+        """
+        sinks = {worker.sink.name: worker.metrics() for worker in self._workers}
+        total = {k: sum(m[k] for m in sinks.values()) for k in ("dropped", "sent", "deferred", "retries", "failed", "pending")}
+        return {
+            "queue_depth": self._queue.qsize(),
+            "received": self.received,
+            "dropped": self.dropped + total["dropped"],
+            "alerts": self.alerts,
+            "suppressed": self.suppressed,
+            "sent": total["sent"],
+            "deferred": total["deferred"],
+            "retries": total["retries"],
+            "failed": total["failed"],
+            "pending": total["pending"],
+            "sinks": sinks,
+        }
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            wake = [now + 1.0]
+            if self._groups:
+                wake.append(min(g["opened"] for g in self._groups.values()) + self.window)
+            try:
+                item = self._queue.get(timeout=max(min(wake) - now, 0))
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, tuple) and item and item[0] is _STOP:
+                self._drain(deadline=item[1])
+                return
+            if item is not None:
+                self._add(item)
+
+            self._close_groups(force=False)
+
+    def _add(self, record: dict):
+        self.received += 1
+        key = (record["decision"], record.get(self.group_by))
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = {"opened": time.monotonic(), "events": []}
+        group["events"].append(record)
+
+    def _close_groups(self, force: bool):
+        now = time.monotonic()
+        for key in [k for k, g in self._groups.items() if force or now - g["opened"] >= self.window]:
+            events = self._groups.pop(key)["events"]
+            last = self._last_alert.get(key)
+            if last is not None and now - last < self.dedup_seconds:
+                self.suppressed += 1
+                self._suppressed[key] = self._suppressed.get(key, 0) + len(events)
+                continue
+            self._last_alert[key] = now
+            alert = self._build_alert(key, events, self._suppressed.pop(key, 0))
+            self.alerts += 1
+            for worker in self._workers:
+                worker.put(alert)
+
+        if len(self._last_alert) > 10000:
+            expired = [k for k, t in self._last_alert.items() if now - t >= self.dedup_seconds]
+            for k in expired:
+                del self._last_alert[k]
+                self._suppressed.pop(k, None)
+
+    def _build_alert(self, key, events, suppressed_before: int) -> dict:
+        decision, group_value = key
+        return {
+            "decision": decision,
+            "group_by": self.group_by,
+            "group": group_value,
+            "events": len(events),
+            "suppressed_since_last_alert": suppressed_before,
+            "users": sorted({e.get("user_id") for e in events}, key=str),
+            "countries": sorted({e.get("country") for e in events}, key=str),
+            "actions": sorted({e.get("action") for e in events}, key=str),
+            "first_seen": events[0].get("timestamp"),
+            "last_seen": events[-1].get("timestamp"),
+            "max_final_risk": max(e.get("final_risk", 0) for e in events),
+        }
+
+    def _drain(self, deadline: float):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if not (isinstance(item, tuple) and item and item[0] is _STOP):
+                self._add(item)
+        self._close_groups(force=True)
+        for worker in self._workers:
+            worker.stop(deadline)
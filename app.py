@@ -1,15 +1,46 @@
 import streamlit as st
 import pandas as pd
-import joblib
 from datetime import datetime
 import os
 import base64
+import atexit
+import json
+
+from rollups import DECISIONS, LEVELS, RollupStore, compact_history
+from scoring_state import (
+    ScoringState, compact_history_file, history_position, position_valid, read_history_after, restore_state,
+)
+from history_writer import HistoryWriter
+from alerts import AlertDispatcher, FileSink, SyslogSink, WebhookSink
+from peer_baselines import PeerBaselines
+from feedback import LABELS, record_feedback
+from attribution import ForestAttribution
+from mapped_model import MAPPED_MODEL_DIR, load_model
+from scoring import ACTION_OPTIONS, COUNTRY_OPTIONS, HISTORY_COLS, features_from_event, score_attempt
 
 
 MODEL_FILE = "gart_model.pkl"
 HISTORY_FILE = "gart_user_history.csv"
 ABSHER_LOGO_PATH = "absher_logo.png.png"
 TUWAIQ_LOGO_PATH = "tuwaiq_logo.png.png"
+ROLLUP_DIR = "gart_rollups"
+ROLLUP_SAVE_SECONDS = 60
+RAW_RETENTION_DAYS = 30
+HISTORY_BATCH_SIZE = 100
+HISTORY_FLUSH_SECONDS = 1.0
+PEER_BASELINES_FILE = "gart_peer_baselines.pkl"
+FEEDBACK_FILE = "gart_feedback.csv"
+ALERT_FILE = "gart_alerts.jsonl"
+ALERT_WEBHOOK_URL = None
+ALERT_SYSLOG_ADDRESS = None
+ALERT_GROUP_BY = "user_id"
+RECENT_CAPACITY = 1000
+RECENT_PER_USER = 50
+RECENT_USERS = 500
+RECENT_PAGE_SIZES = [25, 50, 100]
+STATE_SNAPSHOT_FILE = "gart_state_snapshot.pkl"
+STATE_SNAPSHOT_SECONDS = 60
+COMPACT_SLACK_DAYS = 1
 
 
 st.set_page_config(
@@ -38,246 +69,139 @@ absher_b64 = load_logo_base64(ABSHER_LOGO_PATH) if os.path.exists(ABSHER_LOGO_PA
 tuwaiq_b64 = load_logo_base64(TUWAIQ_LOGO_PATH) if os.path.exists(TUWAIQ_LOGO_PATH) else None
 
 
-COUNTRY_OPTIONS = [
-    
-    "Saudi Arabia (KSA)",
-    "United Arab Emirates",
-    "Qatar",
-    "Bahrain",
-    "Kuwait",
-    "Oman",
-    
-    "Jordan",
-    "Egypt",
-    "Morocco",
-    "Algeria",
-    "Tunisia",
-    "Lebanon",
-    "Iraq",
-    "Syria",
-    "Palestine",
-    "Yemen",
-    "Sudan",
-    
-    "United States",
-    "United Kingdom",
-    "Canada",
-    "Germany",
-    "France",
-    "Spain",
-    "Italy",
-    "Netherlands",
-    "Switzerland",
-    "India",
-    "Pakistan",
-    "Philippines",
-    "China",
-    "Japan",
-    "South Korea",
-    "Brazil",
-    "South Africa",
-    
-    "Other",
-]
-
-
-HIGH_RISK_COUNTRIES = {
-    "Iraq",
-    "Syria",
-    "Yemen",
-    "Sudan",
-    "Brazil",        
-    "South Africa",  
+LEVEL_DISPLAY = {
+    "LOW": ("🟢", "Login allowed – behavior and risk are within normal range."),
+    "MEDIUM": ("🟡", "Require additional verification (OTP / Face ID)."),
+    "HIGH": ("🔴", "Block request and alert the security team."),
 }
 
-def map_country_to_model(country_ui: str) -> str:
-    """
-    Map the UI country selection to the 3 categories
-    the model was trained on: KSA, Unknown, HighRiskCountry
-    """
-    if country_ui in ["Saudi Arabia (KSA)", "KSA"]:
-        return "KSA"
-    if country_ui in HIGH_RISK_COUNTRIES:
-        return "HighRiskCountry"
-    return "Unknown"
-
-
-
-ACTION_OPTIONS = [
-    
-    "view_profile",
-    "view_services",
-    "view_violations",
-    "view_vehicle_list",
-    "view_passport_details",
-
-    
-    "update_mobile",
-    "update_email",
-    "update_address",
-    "renew_id",
-    "replace_lost_id",
-    "digital_id_access",
-
-    "renew_passport",
-    "issue_passport",
-    "replace_lost_passport",
-
-    "renew_driver_license",
-    "replace_lost_license",
-    "pay_violation",
-
-    "vehicle_transfer",
-    "renew_vehicle_registration",
-    "insurance_verification",
-
-    "issue_worker_exit_reentry",
-    "cancel_exit_reentry",
-    "update_sponsor",
-    "renew_worker_iqama",
-
-    "issue_birth_certificate",
-    "add_newborn",
-    "book_civil_appointment",
-
-    "book_appointment",
-    "cancel_appointment",
-    "reschedule_appointment",
-
-    "pay_fees",
-    "pay_ticket",
-    "pay_gov_services",
-
-    "report_cybercrime",
-    "emergency_alert",
-    "travel_permission_status",
-]
-
-def map_action_to_model(action_ui: str) -> str:
+
+@st.cache_resource(max_entries=1)
+def load_scoring_model(version):
     """
-    Map the UI action selection to the 4 action categories
-    used when training the model: view, pay, renew_passport, update_mobile
+    Loaded once per model version (update_model.py replaces the file,
+    mapped_model.py export refreshes the memory-mapped copy).
     """
-    if action_ui.startswith("view_"):
-        return "view"
-
-    if action_ui.startswith("pay_") or action_ui in ["pay_gov_services"]:
-        return "pay"
+    model = load_model(MODEL_FILE, MAPPED_MODEL_DIR)
+    return model, ForestAttribution(model)
 
-    if "passport" in action_ui and "renew" in action_ui:
-        return "renew_passport"
+mapped_meta = os.path.join(MAPPED_MODEL_DIR, "meta.json")
+model, attribution = load_scoring_model((
+    os.path.getmtime(MODEL_FILE),
+    os.path.getmtime(mapped_meta) if os.path.exists(mapped_meta) else None,
+))
 
-    if action_ui in [
-        "update_mobile",
-        "update_email",
-        "update_address",
-        "digital_id_access",
-    ]:
-        return "update_mobile"
 
-    
-    return "view"
+@st.cache_resource
+def load_peer_baselines():
+    if os.path.exists(PEER_BASELINES_FILE):
+        return PeerBaselines.load(PEER_BASELINES_FILE)
+    return None
 
+peer_baselines = load_peer_baselines()
 
 
-model = joblib.load(MODEL_FILE)
+history_cols = HISTORY_COLS
 
 
-history_cols = [
-    "timestamp", "user_id", "country", "device", "action", "hour",
-    "VPN", "failed_logins", "typing_speed",
-    "model_risk", "behavior_risk", "final_risk",
-    "level", "decision"
-]
-
-if os.path.exists(HISTORY_FILE):
-    history_df = pd.read_csv(HISTORY_FILE)
-else:
-    history_df = pd.DataFrame(columns=history_cols)
-
-if "events" not in st.session_state:
-    st.session_state["events"] = history_df.to_dict(orient="records")
-
-
-
-def compute_behavior_deviation(user_id, attempt_row, full_history):
+@st.cache_resource
+def load_rollup_store():
     """
-    Returns (behavior_risk_score 0-100, reasons list) based on this user's history.
-    History uses the same columns as attempt_row: country, device, action, hour, VPN, failed_logins, typing_speed
+    Rollups as last saved plus the history rows written after them, so a
+    crash between appending rows and saving the rollups loses nothing.
     """
-    user_hist = full_history[full_history["user_id"] == user_id]
-
-    if user_hist.empty:
-        return 0, ["First login or limited history – baseline is being established for this user."]
-
-    reasons = []
-    diffs = 0
-    checks = 0
-
-    checks += 1
-    common_country = user_hist["country"].mode()[0]
-    if attempt_row["country"].iloc[0] != common_country:
-        diffs += 1
-        reasons.append(
-            f"Unusual country: user usually logs in from {common_country}, "
-            f"now from {attempt_row['country'].iloc[0]}."
-        )
-
-    checks += 1
-    common_device = user_hist["device"].mode()[0]
-    if attempt_row["device"].iloc[0] != common_device:
-        diffs += 1
-        reasons.append(
-            f"Unusual device: typical device is {common_device}, "
-            f"now using {attempt_row['device'].iloc[0]}."
-        )
-
-    checks += 1
-    action_col = "action_model" if "action_model" in user_hist.columns else "action"
-    common_action = user_hist[action_col].mode()[0]
-    current_action = attempt_row["action"].iloc[0]
-    if current_action != common_action:
-        diffs += 1
-        reasons.append(
-            f"Unusual action: usual action is {common_action}, "
-            f"now requesting {current_action}."
-        )
-
-    checks += 1
-    avg_hour = user_hist["hour"].mean()
-    hour_now = attempt_row["hour"].iloc[0]
-    if abs(hour_now - avg_hour) > 5:
-        diffs += 1
-        reasons.append(
-            f"Unusual time: average login around {avg_hour:.1f}h, now at {hour_now}h."
-        )
-
-    checks += 1
-    avg_speed = user_hist["typing_speed"].mean()
-    speed_now = attempt_row["typing_speed"].iloc[0]
-    if abs(speed_now - avg_speed) > 2:
-        diffs += 1
-        reasons.append(
-            f"Typing pattern changed: normal speed ~{avg_speed:.1f} chars/sec, now {speed_now:.1f}."
-        )
-
-    checks += 1
-    avg_fail = user_hist["failed_logins"].mean()
-    fails_now = attempt_row["failed_logins"].iloc[0]
-    if fails_now >= avg_fail + 2:
-        diffs += 1
-        reasons.append(
-            f"More failed logins than usual: average {avg_fail:.1f}, now {fails_now}."
-        )
-
-    deviation_ratio = diffs / max(checks, 1)
-    behavior_risk = int(deviation_ratio * 100)
+    store = RollupStore(ROLLUP_DIR)
+    if not store.load():
+        if os.path.exists(HISTORY_FILE):
+            store.add_events(pd.read_csv(HISTORY_FILE), history_position(HISTORY_FILE))
+    elif position_valid(HISTORY_FILE, store.position):
+        store.add_events(read_history_after(HISTORY_FILE, store.position), history_position(HISTORY_FILE))
+    else:
+        # Rollups saved before they recorded a position: nothing to compare
+        # against, start counting from the current end of the history.
+        store.position = history_position(HISTORY_FILE)
+    store.save()
+    return store
 
-    if behavior_risk == 0:
-        reasons.append("Behavior closely matches user’s historical pattern.")
+rollup_store = load_rollup_store()
 
-    return behavior_risk, reasons
 
+@st.cache_resource
+def load_scoring_state(_store: RollupStore):
+    """
+    Per-user baselines, counters and recent events, restored from the last
+    snapshot plus the history rows written after it. Old raw events are
+    compacted here, once they are COMPACT_SLACK_DAYS past the retention, so
+    the history file stays small. The restored state and the rollups already
+    cover the compacted rows, so both are kept and only re-anchored to the
+    rewritten file; compaction never forces a rebuild from the whole history.
+    """
+    state, info = restore_state(HISTORY_FILE, STATE_SNAPSHOT_FILE, RECENT_CAPACITY, RECENT_PER_USER, RECENT_USERS)
+    compacted = 0
+    if os.path.exists(HISTORY_FILE):
+        # The history is append-only, so the first row is the oldest.
+        oldest = pd.read_csv(HISTORY_FILE, nrows=1)
+        if not compact_history(oldest, RAW_RETENTION_DAYS + COMPACT_SLACK_DAYS)[1].empty:
+            compacted = compact_history_file(HISTORY_FILE, RAW_RETENTION_DAYS, capacity=RECENT_CAPACITY,
+                                             per_user=RECENT_PER_USER, max_users=RECENT_USERS, state=state)
+            if compacted:
+                _store.position = state.position
+                _store.save()
+
+    if info["source"] != "snapshot" or info["replayed"] or compacted:
+        state.save(STATE_SNAPSHOT_FILE)
+    return state, info
+
+scoring_state, restore_info = load_scoring_state(rollup_store)
+
+
+@st.cache_resource
+def start_history_writer(_store: RollupStore, _state: ScoringState):
+    def update_derived_state(records):
+        batch = pd.DataFrame(records)
+        position = history_position(HISTORY_FILE)
+        # Each side folds the batch even if the other fails. A side that
+        # fails stops saving, so its saved position never skips these rows.
+        try:
+            _state.add_events(batch, position, recent=False)
+            _state.save_if_due(STATE_SNAPSHOT_FILE, STATE_SNAPSHOT_SECONDS)
+        finally:
+            _store.add_events(batch, position)
+            _store.save_if_due(ROLLUP_SAVE_SECONDS)
+
+    writer = HistoryWriter(
+        HISTORY_FILE,
+        history_cols,
+        batch_size=HISTORY_BATCH_SIZE,
+        flush_interval=HISTORY_FLUSH_SECONDS,
+        on_flush=update_derived_state,
+    ).start()
+
+    def shutdown():
+        writer.stop()
+        _state.save(STATE_SNAPSHOT_FILE)
+        _store.prune()
+        _store.save()
+
+    atexit.register(shutdown)
+    return writer
+
+history_writer = start_history_writer(rollup_store, scoring_state)
+
+
+@st.cache_resource
+def start_alert_dispatcher():
+    sinks = [FileSink(ALERT_FILE)]
+    if ALERT_WEBHOOK_URL:
+        sinks.append(WebhookSink(ALERT_WEBHOOK_URL))
+    if ALERT_SYSLOG_ADDRESS:
+        sinks.append(SyslogSink(ALERT_SYSLOG_ADDRESS))
+    dispatcher = AlertDispatcher(sinks, group_by=ALERT_GROUP_BY).start()
+    atexit.register(dispatcher.stop)
+    return dispatcher
+
+alert_dispatcher = start_alert_dispatcher()
+recent_events = scoring_state.recent
 
 
 st.markdown('<div class="cyber-bg">', unsafe_allow_html=True)
@@ -367,56 +291,17 @@ with tab_live:
         submitted = st.form_submit_button("Check Risk | تقييم مستوى الخطورة", use_container_width=True)
 
     if submitted:
-        country_model = map_country_to_model(country_ui)
-        action_model = map_action_to_model(action_ui)
-
-        features_row = pd.DataFrame([{
-            "user_id": user_id,
-            "time_of_day": time_of_day,
-            "country": country_model,
-            "device_type": device_type,
-            "failed_logins_last_hour": failed_logins_last_hour,
-            "action_type": action_model,
-            "is_vpn": is_vpn,
-            "typing_speed": typing_speed
-        }])
-
-        prob_attack = model.predict_proba(features_row)[0][1]
-        model_risk = int(prob_attack * 100)
-
-        attempt_for_behavior = pd.DataFrame([{
-            "user_id": user_id,
-            "country": country_ui,  
-            "country_model": country_model,  
-            "device": device_type,
-            "action": action_model,
-            "hour": time_of_day,
-            "VPN": "Yes" if is_vpn == 1 else "No",
-            "failed_logins": failed_logins_last_hour,
-            "typing_speed": typing_speed
-        }])
-
-        behavior_risk, behavior_reasons = compute_behavior_deviation(
-            user_id, attempt_for_behavior, history_df
+        record, behavior_reasons = score_attempt(
+            model, None, user_id, country_ui, device_type, action_ui, time_of_day,
+            failed_logins_last_hour, is_vpn, typing_speed,
+            peers=peer_baselines, attribution=attribution, profiles=scoring_state.profiles,
         )
-
-        final_risk = min(100, int(0.6 * model_risk + 0.4 * behavior_risk))
-
-        if final_risk < 30:
-            level = "LOW"
-            color = "🟢"
-            decision = "Allow"
-            message = "Login allowed – behavior and risk are within normal range."
-        elif final_risk < 60:  
-            level = "MEDIUM"
-            color = "🟡"
-            decision = "Challenge"
-            message = "Require additional verification (OTP / Face ID)."
-        else:
-            level = "HIGH"
-            color = "🔴"
-            decision = "Block"
-            message = "Block request and alert the security team."
+        model_risk = record["model_risk"]
+        behavior_risk = record["behavior_risk"]
+        final_risk = record["final_risk"]
+        level = record["level"]
+        decision = record["decision"]
+        color, message = LEVEL_DISPLAY[level]
 
         st.markdown("### Risk Evaluation | تقييم مستوى الخطورة")
         col_r1, col_r2, col_r3 = st.columns(3)
@@ -431,45 +316,33 @@ with tab_live:
         for r in behavior_reasons:
             st.markdown(f"- {r}")
 
-        
-        record = {
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "user_id": user_id,
-            "country": country_ui,  
-            "device": device_type,
-            "action": action_ui,  
-            "action_model": action_model,  
-            "hour": time_of_day,
-            "VPN": "Yes" if is_vpn == 1 else "No",
-            "failed_logins": failed_logins_last_hour,
-            "typing_speed": typing_speed,
-            "model_risk": model_risk,
-            "behavior_risk": behavior_risk,
-            "final_risk": final_risk,
-            "level": level,
-            "decision": decision
-        }
+        if record["risk_contributions"]:
+            risk_contributions = json.loads(record["risk_contributions"])
+            st.markdown("#### Model risk drivers | العوامل المؤثرة في تقييم النموذج")
+            for feature_name, points in list(risk_contributions.items())[:5]:
+                st.markdown(f"- {feature_name}: {points:+.1f} risk points")
+
 
-        history_df = pd.concat([history_df, pd.DataFrame([record])], ignore_index=True)
-        history_df.to_csv(HISTORY_FILE, index=False)
-        st.session_state["events"].append(record)
+        scoring_state.append(record)
+        history_writer.submit(record)
+        alert_dispatcher.submit(record)
 
 
 with tab_soc:
     st.markdown("### Security Operations Overview | لوحة المراقبة الأمنية")
 
-    if not st.session_state["events"]:
+    if not scoring_state.events:
         st.info("No login attempts yet. Use the **Live Risk Check** tab to generate events.")
     else:
-        log_df = pd.DataFrame(st.session_state["events"])
 
         
         col_a, col_b, col_c, col_d = st.columns(4)
-        total = len(log_df)
-        blocked = (log_df["decision"] == "Block").sum()
-        challenged = (log_df["decision"] == "Challenge").sum()
-        allowed = (log_df["decision"] == "Allow").sum()
-        unique_users = log_df["user_id"].nunique()
+        totals = rollup_store.totals()
+        total = int(totals["count"])
+        blocked = int(totals["block"])
+        challenged = int(totals["challenge"])
+        allowed = int(totals["allow"])
+        unique_users = rollup_store.unique_users()
 
         col_a.metric("Total attempts", total)
         col_b.metric("Blocked", blocked)
@@ -479,26 +352,46 @@ with tab_soc:
         st.markdown("<div class='spacer-xs'></div>", unsafe_allow_html=True)
 
         
-        high_risk_df = log_df[log_df["level"] == "HIGH"]
-        high_risk_count = len(high_risk_df)
+        high_risk_count = int(totals["high"])
         high_risk_pct = (high_risk_count / total * 100) if total > 0 else 0
 
-        med_risk_df = log_df[log_df["level"] == "MEDIUM"]
-
         col_hr1, col_hr2, col_hr3 = st.columns(3)
         col_hr1.metric("High-risk attempts (HIGH)", high_risk_count)
         col_hr2.metric("High-risk percentage", f"{high_risk_pct:.1f}%")
         col_hr3.metric("Unique users", unique_users)
 
+        writer_metrics = history_writer.metrics()
+        col_w1, col_w2, col_w3, col_w4 = st.columns(4)
+        col_w1.metric("History write queue", writer_metrics["queue_depth"])
+        col_w2.metric("Last flush latency", f"{writer_metrics['last_flush_ms']:.1f} ms")
+        col_w3.metric("Max flush latency", f"{writer_metrics['max_flush_ms']:.1f} ms")
+        col_w4.metric("History spilled / lost", f"{writer_metrics['spilled']} / {writer_metrics['dropped']}")
+        st.caption(
+            f"Flush latencies include updating the rollups and scoring state: "
+            f"last {writer_metrics['last_on_flush_ms']:.1f} ms, max {writer_metrics['max_on_flush_ms']:.1f} ms"
+        )
+        if writer_metrics["dropped"]:
+            st.error(f"{writer_metrics['dropped']} history records could not be written (history and spill file both failed).")
+        st.caption(
+            f"Scoring state restored from {restore_info['source']} in {restore_info['seconds'] * 1000:.0f} ms "
+            f"({restore_info['replayed']} rows replayed, history {restore_info['history_bytes'] / 2**20:.1f} MB)"
+        )
+
+        alert_metrics = alert_dispatcher.metrics()
+        col_al1, col_al2, col_al3 = st.columns(3)
+        col_al1.metric("Alerts sent", alert_metrics["sent"])
+        col_al2.metric("Alerts pending", alert_metrics["queue_depth"] + alert_metrics["pending"])
+        col_al3.metric("Alerts suppressed / failed", f"{alert_metrics['suppressed']} / {alert_metrics['failed']}")
+
         st.markdown("<div class='spacer-sm'></div>", unsafe_allow_html=True)
 
         
         st.markdown("#### Risk level distribution | توزيع مستويات الخطورة")
-        risk_counts = (
-            log_df["level"]
-            .value_counts()
-            .reindex(["LOW", "MEDIUM", "HIGH"], fill_value=0)
-        )
+        risk_counts = {
+            "LOW": int(totals["low"]),
+            "MEDIUM": int(totals["medium"]),
+            "HIGH": int(totals["high"]),
+        }
         
         
         risk_chart_html = f"""
@@ -605,7 +498,7 @@ with tab_soc:
 
         
         st.markdown("#### Top countries by attempts (model view) | أكثر الدول من حيث المحاولات")
-        country_counts = log_df["country"].value_counts().head(10)
+        country_counts = scoring_state.top_counts("country", 10)
         if not country_counts.empty:
             countries_list = country_counts.index.tolist()
             attempts_list = country_counts.values.tolist()
@@ -702,7 +595,7 @@ with tab_soc:
 
         
         st.markdown("#### Attempts by action type | توزيع المحاولات حسب نوع الخدمة")
-        action_counts = log_df["action"].value_counts().head(10)
+        action_counts = scoring_state.top_counts("action", 10)
         if not action_counts.empty:
             actions_list = action_counts.index.tolist()
             action_attempts_list = action_counts.values.tolist()
@@ -800,42 +693,75 @@ with tab_soc:
 
         
         st.markdown("#### Last login attempts | آخر محاولات الدخول")
+        f_level, f_decision, f_size, f_page = st.columns(4)
+        level_filter = f_level.selectbox("Level / المستوى", ["All"] + LEVELS, key="recent_level")
+        decision_filter = f_decision.selectbox("Decision / القرار", ["All"] + DECISIONS, key="recent_decision")
+        page_size = f_size.selectbox("Rows per page / عدد الصفوف", RECENT_PAGE_SIZES, index=1, key="recent_page_size")
+        level_filter = None if level_filter == "All" else level_filter
+        decision_filter = None if decision_filter == "All" else decision_filter
+
+        matches = recent_events.count(level_filter, decision_filter)
+        n_pages = max((matches + page_size - 1) // page_size, 1)
+        page_no = f_page.number_input("Page / الصفحة", min_value=1, max_value=n_pages, value=1, key="recent_page")
+        recent_rows, _ = recent_events.page(page_no - 1, page_size, level_filter, decision_filter)
+        recent_df = pd.DataFrame(recent_rows, columns=history_cols)
+        st.caption(f"{matches} most recent matching attempts (newest first), page {page_no} of {n_pages}")
         st.dataframe(
-            log_df.sort_values("timestamp", ascending=False).head(50),
+            recent_df,
             use_container_width=True
         )
 
         
+        st.markdown("#### Analyst feedback | تقييم المحلل")
+        with st.form("feedback_form"):
+            event_idx = st.selectbox(
+                "Event / الحدث",
+                recent_df.index.tolist(),
+                format_func=lambda i: (
+                    f"{recent_df.at[i, 'timestamp']} • user {recent_df.at[i, 'user_id']} • "
+                    f"{recent_df.at[i, 'decision']} ({recent_df.at[i, 'final_risk']})"
+                ),
+            )
+            verdict = st.radio("Outcome / النتيجة", list(LABELS), horizontal=True)
+            feedback_submitted = st.form_submit_button("Save feedback | حفظ التقييم")
+
+        if feedback_submitted and event_idx is not None:
+            event = recent_df.loc[event_idx].to_dict()
+            record_feedback(event, features_from_event(event), LABELS[verdict], FEEDBACK_FILE)
+            st.success("Feedback saved – it will be used by the next `python update_model.py` run.")
+
+        
         st.markdown("---")
         st.markdown("### User Insight & Risk History | ملف المستخدم السلوكي")
 
-        try:
-            log_df["user_id"] = log_df["user_id"].astype(int)
-        except Exception:
-            pass
-
-        user_ids = sorted(log_df["user_id"].unique().tolist())
+        user_ids = recent_events.user_ids()
         selected_user = st.selectbox(
             "Select User ID to inspect | اختر معرّف المستخدم",
             user_ids,
             key="user_inspect"
         )
 
-        user_df = log_df[log_df["user_id"] == selected_user].copy()
-        user_df["timestamp"] = pd.to_datetime(user_df["timestamp"], errors="coerce")
-        user_df = user_df.sort_values("timestamp")
+        user_rows, _ = recent_events.page(0, RECENT_PER_USER, user_id=selected_user)
+        user_df = pd.DataFrame(user_rows, columns=history_cols)
 
         if not user_df.empty:
+            user_totals = rollup_store.totals(user_id=selected_user)
+            user_attempts = int(user_totals["count"])
+            user_avg_risk = user_totals["risk_sum"] / max(user_attempts, 1)
+
             c1, c2, c3 = st.columns(3)
-            c1.metric("Attempts for this user", len(user_df))
-            c2.metric("Average final risk", f"{user_df['final_risk'].mean():.1f}/100")
-            c3.metric("Last decision", user_df.iloc[-1]["decision"])
+            c1.metric("Attempts for this user", user_attempts)
+            c2.metric("Average final risk", f"{user_avg_risk:.1f}/100")
+            c3.metric("Last decision", user_df.iloc[0]["decision"])
 
             st.markdown("#### Risk timeline for this user | تطوّر مستوى الخطورة لهذا المستخدم")
-            line_df = user_df.set_index("timestamp")[["final_risk"]]
+            timeline = rollup_store.query(user_id=selected_user)
+            line_df = timeline.set_index("bucket")[["mean_risk", "risk_max"]].rename(
+                columns={"mean_risk": "mean final_risk", "risk_max": "max final_risk"}
+            )
             st.line_chart(line_df, width="stretch")
 
-            st.markdown("#### History for this user | سجل هذا المستخدم")
+            st.markdown("#### Recent history for this user | آخر سجل هذا المستخدم")
             st.dataframe(
                 user_df[[
                     "timestamp", "country", "device", "action",
@@ -0,0 +1,156 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+def input_feature_map(preprocess):
+    """
+    Map every column produced by the ColumnTransformer back to the input
+    feature it came from (all one-hot columns of `country` map to `country`).
+    Returns (input_feature_names, column_to_input_index).
+    """
+    names = []
+    col_map = np.empty(sum(s.stop - s.start for s in preprocess.output_indices_.values()), dtype=int)
+    for name, trans, cols in preprocess.transformers_:
+        if trans == "drop":
+            continue
+        out = preprocess.output_indices_[name]
+        if hasattr(trans, "categories_"):
+            idx = np.repeat(np.arange(len(cols)), [len(c) for c in trans.categories_])
+        else:
+            idx = np.arange(len(cols))
+        col_map[out] = len(names) + idx
+        names += list(cols)
+    return names, col_map
+
+
+def path_contributions(children_left, children_right, feature, value, col_map, n_inputs, class_idx=1):
+    """
+    Tree path attribution for one tree. Every split moves the predicted
+    probability from the parent node's value to the child's; the difference
+    is credited to the split feature. Returns (bias, L) where bias is the
+    root probability and row `n` of the sparse matrix L holds the summed
+    contributions along the path from the root to node `n`.
+    """
+    n_nodes = len(children_left)
+    prob = value[:, 0, :] / value[:, 0, :].sum(axis=1, keepdims=True)
+    p = prob[:, class_idx]
+
+    parent = np.full(n_nodes, -1)
+    internal = np.flatnonzero(children_left >= 0)
+    parent[children_left[internal]] = internal
+    parent[children_right[internal]] = internal
+
+    # Walk all leaves up to the root at once, one tree level per step.
+    rows, cols, vals = [], [], []
+    owner = node = np.flatnonzero(children_left < 0)
+    while len(node):
+        up = parent[node]
+        keep = up >= 0
+        owner, node, up = owner[keep], node[keep], up[keep]
+        rows.append(owner)
+        cols.append(col_map[feature[up]])
+        vals.append(p[node] - p[up])
+        node = up
+
+    L = sparse.coo_matrix(
+        (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n_nodes, n_inputs),
+    ).tocsr()
+    return p[0], L
+
+
+class ForestAttribution:
+    """
+    Per-input-feature contributions to the attack probability of the
+    RandomForest pipeline, such that
+        bias + contributions.sum(axis=1) == predict_proba(X)[:, 1]
+
+    All trees' leaf contributions are stacked into one sparse matrix, so a
+    batch is explained with one `apply` and one sparse product. Results for
+    repeated feature rows come from an LRU cache.
+    """
+
+    def __init__(self, model, cache_size: int = 4096):
+        self.preprocess = model.named_steps["preprocess"]
+        self.clf = model.named_steps["clf"]
+        self.feature_names, col_map = input_feature_map(self.preprocess)
+        class_idx = list(self.clf.classes_).index(1)
+
+        if hasattr(self.clf, "trees"):
+            trees = self.clf.trees()
+        else:
+            trees = (
+                (est.tree_.children_left, est.tree_.children_right, est.tree_.feature, est.tree_.value)
+                for est in self.clf.estimators_
+            )
+
+        biases, blocks, offsets = [], [], [0]
+        for children_left, children_right, feature, value in trees:
+            bias, L = path_contributions(
+                children_left, children_right, feature, value,
+                col_map, len(self.feature_names), class_idx,
+            )
+            biases.append(bias)
+            blocks.append(L)
+            offsets.append(offsets[-1] + L.shape[0])
+
+        self.n_trees = len(blocks)
+        self.bias = float(np.mean(biases))
+        self.node_contrib = sparse.vstack(blocks, format="csr")
+        self.offsets = np.asarray(offsets[:-1])
+
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _compute(self, X: pd.DataFrame) -> np.ndarray:
+        leaves = self.clf.apply(self.preprocess.transform(X))
+        n = leaves.shape[0]
+        rows = np.repeat(np.arange(n), self.n_trees)
+        nodes = (leaves + self.offsets[None, :]).ravel()
+        S = sparse.csr_matrix(
+            (np.full(n * self.n_trees, 1.0 / self.n_trees), (rows, nodes)),
+            shape=(n, self.node_contrib.shape[0]),
+        )
+        return (S @ self.node_contrib).toarray()
+
+    def explain(self, X: pd.DataFrame) -> np.ndarray:
+        """
+        Contributions for every row of X, shape (n_rows, n_input_features),
+        in probability units. Only rows not in the cache are computed.
+        """
+        keys = list(X.itertuples(index=False, name=None))
+        out = np.empty((len(keys), len(self.feature_names)))
+        missing = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                hit = self._cache.get(key)
+                if hit is None:
+                    missing.append(i)
+                else:
+                    self._cache.move_to_end(key)
+                    out[i] = hit
+
+        if missing:
+            out[missing] = self._compute(X.iloc[missing])
+            with self._lock:
+                for i in missing:
+                    self._cache[keys[i]] = out[i].copy()
+                    if len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+        return out
+
+    def explain_records(self, X: pd.DataFrame, top: int = None) -> list:
+        """
+        Same as explain(), as one {feature: contribution in risk points}
+        dict per row, largest absolute contribution first.
+        """
+        records = []
+        for row in self.explain(X):
+            order = np.argsort(-np.abs(row))[:top]
+            records.append({self.feature_names[j]: round(float(row[j]) * 100, 1) for j in order})
+        return records
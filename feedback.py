@@ -0,0 +1,52 @@
+import csv
+import os
+from datetime import datetime
+
+import pandas as pd
+
+
+FEEDBACK_FILE = "gart_feedback.csv"
+
+FEATURE_COLS = [
+    "user_id", "time_of_day", "country", "device_type",
+    "failed_logins_last_hour", "action_type", "is_vpn", "typing_speed",
+]
+
+FEEDBACK_COLS = ["labelled_at", "event_timestamp", "decision", "final_risk"] + FEATURE_COLS + ["label"]
+
+LABELS = {
+    "Confirmed attack": 1,
+    "False positive": 0,
+}
+
+
+def record_feedback(event: dict, features: dict, label: int, path: str = FEEDBACK_FILE):
+    """
+    Append one analyst verdict. `features` are the model inputs of the event
+    (same columns as gart_data.csv without the label) so the updater does not
+    need the raw history, which may have been compacted by then.
+    """
+    row = {
+        "labelled_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "event_timestamp": event.get("timestamp"),
+        "decision": event.get("decision"),
+        "final_risk": event.get("final_risk"),
+        **{c: features[c] for c in FEATURE_COLS},
+        "label": int(label),
+    }
+    write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+    with open(path, "a", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=FEEDBACK_COLS)
+        if write_header:
+            writer.writeheader()
+        writer.writerow(row)
+
+
+def load_feedback(path: str = FEEDBACK_FILE, start: int = 0) -> pd.DataFrame:
+    """
+    Labelled events from row `start` onwards (0 = the first labelled event).
+    """
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=FEEDBACK_COLS)
+    df = pd.read_csv(path)
+    return df.iloc[start:].reset_index(drop=True)
@@ -0,0 +1,332 @@
+import csv
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class HistoryWriter:
+    """
+    Appends history records to a CSV from a background thread.
+
+    Records are handed over through a bounded queue, so the caller never
+    waits for disk I/O. The writer batches them and flushes when
+    `batch_size` records are pending or `flush_interval` seconds have passed.
+    `stop()` drains the queue and fsyncs the file.
+
+    History rows are security decisions, so a full queue does not drop
+    them: a record that cannot be queued within `put_timeout` is appended
+    to a spill file (`path` + ".spill", JSON lines) and moved into the
+    history with the next flush. A batch that cannot be appended to the
+    history goes to the spill file too and is retried with the next flush.
+    Only if the spill file cannot be written either is a record dropped,
+    and counted.
+
+    `on_flush(records)` is called from the writer thread after every batch,
+    e.g. to fold the batch into the rollups. Flush latencies include it;
+    its own share is reported as `*_on_flush_ms`.
+    """
+
+    def __init__(self, path: str, columns, max_queue: int = 10000, batch_size: int = 100,
+                 flush_interval: float = 1.0, put_timeout: float = 0.05, on_flush=None):
+        self.path = path
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.on_flush = on_flush
+        self.spill_path = path + ".spill"
+
+        # Held while the file is written; anyone rewriting the history file
+        # (e.g. compaction) must take it too.
+        self.lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+
+        self.written = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.batches = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+        self.last_on_flush_ms = 0.0
+        self.max_on_flush_ms = 0.0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="gart-history-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def submit(self, record: dict) -> bool:
+        """
+        Queue a record for writing. Only waits `put_timeout` seconds if the
+        queue is full; the record goes to the spill file after that.
+        Returns False only if the record was lost.
+        """
+        try:
+            self._queue.put(record, timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            pass
+        try:
+            with self._spill_lock:
+                self._write_spill([record])
+            return True
+        except OSError:
+            self.dropped += 1
+            logger.exception("History queue full and spill failed, dropped record for user %s",
+                             record.get("user_id"))
+            return False
+
+    def stop(self, timeout: float = 10.0):
+        """
+        Flush everything still queued and fsync the file.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """
+        Block until everything submitted before this call is on disk.
+        """
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def read_users(self, user_ids) -> list:
+        """
+        Rows of `user_ids` as written (dicts of strings), after flushing what
+        is queued. Used to hand those users to another shard.
+        """
+        self.flush()
+        wanted = {str(u) for u in user_ids}
+        with self.lock:
+            if self._read_header() is None:
+                return []
+            with open(self.path, newline="", encoding="utf-8") as f:
+                return [row for row in csv.DictReader(f) if row["user_id"] in wanted]
+
+    def remove_users(self, user_ids):
+        """
+        Rewrite the file without the rows of `user_ids`, after flushing what
+        is queued. Used when those users move to another shard.
+        """
+        self.flush()
+        drop = {str(u) for u in user_ids}
+        with self.lock:
+            if self._read_header() is None:
+                return 0
+            tmp_path = self.path + ".tmp"
+            removed = 0
+            with open(self.path, newline="", encoding="utf-8") as src, \
+                    open(tmp_path, "w", newline="", encoding="utf-8") as dst:
+                reader = csv.reader(src)
+                writer = csv.writer(dst)
+                header = next(reader)
+                writer.writerow(header)
+                uid_idx = header.index("user_id")
+                for row in reader:
+                    if row[uid_idx] in drop:
+                        removed += 1
+                    else:
+                        writer.writerow(row)
+            os.replace(tmp_path, self.path)
+        return removed
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def spill_pending(self) -> bool:
+        return os.path.exists(self.spill_path)
+
+    def metrics(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth(),
+            "written": self.written,
+            "spilled": self.spilled,
+            "spill_pending": self.spill_pending(),
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "last_flush_ms": self.last_flush_ms,
+            "max_flush_ms": self.max_flush_ms,
+            "mean_flush_ms": self._total_flush_ms / self.batches if self.batches else 0.0,
+            "last_on_flush_ms": self.last_on_flush_ms,
+            "max_on_flush_ms": self.max_on_flush_ms,
+        }
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                # Pick up anything submitted concurrently with stop().
+                waiting = []
+                while True:
+                    try:
+                        extra = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if isinstance(extra, threading.Event):
+                        waiting.append(extra)
+                    elif extra is not _STOP:
+                        batch.append(extra)
+                self._flush(batch, durable=True)
+                for done in waiting:
+                    done.set()
+                return
+
+            if isinstance(item, threading.Event):
+                self._flush(batch)
+                batch = []
+                item.set()
+            elif item is not None:
+                batch.append(item)
+
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                if batch or self.spill_pending():
+                    self._flush(batch)
+                    batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+    def _flush(self, batch, durable: bool = False):
+        start = time.perf_counter()
+        # The spill file is only removed once its rows are in the history.
+        with self._spill_lock:
+            queued = batch
+            try:
+                batch = queued + self._read_spill()
+                if not batch and not durable:
+                    return
+                with self.lock:
+                    self._append(batch, durable)
+            except Exception:
+                logger.exception("Failed to write %d history records", len(batch))
+                self._retry_later(queued)
+                return
+            try:
+                if os.path.exists(self.spill_path):
+                    os.remove(self.spill_path)
+            except OSError:
+                # The spilled rows would be appended twice; keep the file
+                # and live with that rather than lose the queued ones.
+                logger.exception("Could not remove %s", self.spill_path)
+
+        if batch and self.on_flush is not None:
+            on_flush_start = time.perf_counter()
+            try:
+                self.on_flush(batch)
+            except Exception:
+                logger.exception("History on_flush callback failed")
+            self.last_on_flush_ms = (time.perf_counter() - on_flush_start) * 1000
+            self.max_on_flush_ms = max(self.max_on_flush_ms, self.last_on_flush_ms)
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if batch:
+            self.written += len(batch)
+            self.batches += 1
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self._total_flush_ms += elapsed_ms
+
+    def _retry_later(self, records):
+        """
+        Put queued records whose append failed in the spill file, so the
+        next flush retries them. Called with the spill lock held.
+        """
+        if not records:
+            return
+        try:
+            self._write_spill(records)
+        except OSError:
+            self.dropped += len(records)
+            logger.exception("Spill failed too, dropped %d history records", len(records))
+
+    def _write_spill(self, records):
+        with open(self.spill_path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, default=str) + "\n")
+        self.spilled += len(records)
+
+    def _read_spill(self) -> list:
+        if not os.path.exists(self.spill_path):
+            return []
+        with open(self.spill_path, encoding="utf-8") as f:
+            # A line cut short by a crash mid-write is the only one that can fail.
+            records = []
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logger.error("Skipping unreadable spilled history record")
+            return records
+
+    def _append(self, batch, durable: bool):
+        header = self._read_header()
+        if header is None:
+            header = list(self.columns)
+            for record in batch:
+                header += [k for k in record if k not in header]
+            write_header = True
+        else:
+            write_header = False
+            new_cols = [k for record in batch for k in record if k not in header]
+            if new_cols:
+                self._widen_header(header, list(dict.fromkeys(new_cols)))
+                header = self._read_header()
+
+        end = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        try:
+            with open(self.path, "a", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, fieldnames=header, extrasaction="ignore")
+                if write_header:
+                    writer.writeheader()
+                writer.writerows(batch)
+                if durable:
+                    f.flush()
+                    os.fsync(f.fileno())
+        except Exception:
+            # Cut off a partly written batch so its retry is not a duplicate.
+            if os.path.exists(self.path):
+                os.truncate(self.path, end)
+            raise
+
+    def _read_header(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return None
+        with open(self.path, newline="", encoding="utf-8") as f:
+            return next(csv.reader(f), None)
+
+    def _widen_header(self, header, new_cols):
+        # Rare: a record carries a column the file does not have yet. Rewrite
+        # the file once with the wider header; old rows get empty values.
+        tmp_path = self.path + ".tmp"
+        with open(self.path, newline="", encoding="utf-8") as src, \
+                open(tmp_path, "w", newline="", encoding="utf-8") as dst:
+            reader = csv.reader(src)
+            writer = csv.writer(dst)
+            next(reader)
+            writer.writerow(header + new_cols)
+            for row in reader:
+                writer.writerow(row + [""] * len(new_cols))
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,247 @@
+"""
+Load generator for the GART scoring path.
+
+Replays a mix of normal sessions and attack campaigns (credential stuffing
+bursts, VPN + passport renewal, impossible travel) against an in-process
+Scorer, a scoring_server.py instance or the sharding.py router, then
+reports throughput, latency percentiles and the decision mix over time.
+
+    python loadtest.py --concurrency 8 --duration 30
+    python loadtest.py --url http://127.0.0.1:8502 --concurrency 32 --requests 20000
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+
+import numpy as np
+
+from scoring import ACTION_OPTIONS, COUNTRY_OPTIONS, HIGH_RISK_COUNTRIES
+from scoring_server import ScoringClient, load_scorer
+
+
+HOME_COUNTRY = "Saudi Arabia (KSA)"
+GCC_COUNTRIES = COUNTRY_OPTIONS[:6]
+FOREIGN_COUNTRIES = [c for c in COUNTRY_OPTIONS if c not in GCC_COUNTRIES and c != "Other"]
+ATTACK_COUNTRIES = sorted(HIGH_RISK_COUNTRIES) + ["Other"]
+
+VIEW_ACTIONS = [a for a in ACTION_OPTIONS if a.startswith("view_")]
+# The VPN + passport renewal scenario; view / issue / replace are not renewals.
+PASSPORT_ACTIONS = ["renew_passport"]
+
+DEFAULT_MIX = {
+    "normal": 0.85,
+    "credential_stuffing": 0.07,
+    "vpn_passport": 0.04,
+    "impossible_travel": 0.04,
+}
+
+DECISIONS = ["Allow", "Challenge", "Block"]
+
+# Users are drawn Zipf-distributed over 1..n_users: user k with weight
+# 1 / k**ZIPF_EXPONENT. The busiest user gets about 1 / ln(n_users) of the
+# traffic (10% for 10,000 users), not most of it.
+ZIPF_EXPONENT = 1.0
+
+
+class TrafficGenerator:
+    """
+    Thread-safe stream of (scenario, request) pairs. Every user keeps a
+    stable home profile so normal traffic builds realistic histories;
+    campaigns are queued as bursts and drained before new traffic is drawn.
+    """
+
+    def __init__(self, n_users: int = 10000, mix: dict = None, seed: int = 42):
+        self.n_users = n_users
+        self.mix = mix or DEFAULT_MIX
+        self.rng = random.Random(seed)
+        self.profiles = {}
+        self.pending = deque()
+        self._user_ids = range(1, n_users + 1)
+        self._user_weights = list(itertools.accumulate(1 / k ** ZIPF_EXPONENT for k in self._user_ids))
+        self._lock = threading.Lock()
+
+    def _profile(self, user_id: int) -> dict:
+        profile = self.profiles.get(user_id)
+        if profile is None:
+            rng = self.rng
+            profile = {
+                "country": HOME_COUNTRY if rng.random() < 0.85 else rng.choice(GCC_COUNTRIES[1:] + FOREIGN_COUNTRIES),
+                "device": "mobile" if rng.random() < 0.7 else "desktop",
+                "hour": rng.randint(7, 22),
+                "typing_speed": round(rng.uniform(2.5, 6.0), 2),
+                "actions": rng.sample(ACTION_OPTIONS, 3),
+            }
+            self.profiles[user_id] = profile
+        return profile
+
+    def _user(self) -> int:
+        # A few heavy users, a long tail of occasional ones.
+        return self.rng.choices(self._user_ids, cum_weights=self._user_weights)[0]
+
+    def _normal(self, user_id: int) -> dict:
+        rng = self.rng
+        p = self._profile(user_id)
+        return {
+            "user_id": user_id,
+            "country": p["country"],
+            "device": p["device"],
+            "action": rng.choice(p["actions"] + VIEW_ACTIONS[:1]),
+            "hour": (p["hour"] + rng.randint(-2, 2)) % 24,
+            "failed_logins": 1 if rng.random() < 0.05 else 0,
+            "vpn": 1 if rng.random() < 0.03 else 0,
+            "typing_speed": round(min(max(rng.gauss(p["typing_speed"], 0.4), 1.0), 10.0), 2),
+        }
+
+    def _queue_campaign(self, scenario: str):
+        rng = self.rng
+        if scenario == "credential_stuffing":
+            country = rng.choice(ATTACK_COUNTRIES)
+            hour = rng.randint(0, 23)
+            for _ in range(rng.randint(20, 50)):
+                self.pending.append((scenario, {
+                    "user_id": rng.randint(1, self.n_users),
+                    "country": country,
+                    "device": "desktop",
+                    "action": "view_profile",
+                    "hour": hour,
+                    "failed_logins": rng.randint(3, 10),
+                    "vpn": 1 if rng.random() < 0.5 else 0,
+                    "typing_speed": round(rng.uniform(8.0, 10.0), 2),
+                }))
+        elif scenario == "vpn_passport":
+            for _ in range(rng.randint(5, 15)):
+                request = self._normal(self._user())
+                request.update({
+                    "action": rng.choice(PASSPORT_ACTIONS),
+                    "vpn": 1,
+                    "hour": rng.choice([0, 1, 2, 3, 22, 23]),
+                })
+                self.pending.append((scenario, request))
+        elif scenario == "impossible_travel":
+            user_id = self._user()
+            home = self._normal(user_id)
+            away = dict(home, country=rng.choice(FOREIGN_COUNTRIES), device="desktop",
+                        typing_speed=round(rng.uniform(1.0, 10.0), 2))
+            self.pending.append((scenario, home))
+            self.pending.append((scenario, away))
+        else:
+            self.pending.append((scenario, self._normal(self._user())))
+
+    def next(self):
+        with self._lock:
+            if not self.pending:
+                scenario = self.rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+                self._queue_campaign(scenario)
+            return self.pending.popleft()
+
+
+def run_load(score, generator: TrafficGenerator, concurrency: int, n_requests: int = None,
+             duration: float = None) -> tuple:
+    """
+    Drive `score(request) -> dict` from `concurrency` threads until
+    n_requests are sent or `duration` seconds pass.
+    Returns (results, elapsed) with one (finished_at, latency_s, scenario,
+    decision) tuple per request; decision is "error" on failure.
+    """
+    results = []
+    sent = [0]
+    lock = threading.Lock()
+    start = time.perf_counter()
+    deadline = start + duration if duration else None
+
+    def worker():
+        local = []
+        while True:
+            with lock:
+                if n_requests is not None and sent[0] >= n_requests:
+                    break
+                sent[0] += 1
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+            scenario, request = generator.next()
+            t0 = time.perf_counter()
+            try:
+                decision = score(request)["decision"]
+            except Exception:
+                decision = "error"
+            t1 = time.perf_counter()
+            local.append((t1 - start, t1 - t0, scenario, decision))
+        with lock:
+            results.extend(local)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.perf_counter() - start
+
+
+def _mix(decisions) -> str:
+    counts = Counter(decisions)
+    total = max(len(decisions), 1)
+    parts = [f"{d} {counts[d] / total * 100:5.1f}%" for d in DECISIONS]
+    if counts["error"]:
+        parts.append(f"error {counts['error']}")
+    return "  ".join(parts)
+
+
+def report(results, elapsed: float, interval: float = 1.0) -> str:
+    if not results:
+        return "No requests completed."
+    finished = np.array([r[0] for r in results])
+    latency_ms = np.array([r[1] for r in results]) * 1000
+    p50, p90, p95, p99 = np.percentile(latency_ms, [50, 90, 95, 99])
+
+    lines = [
+        f"Requests: {len(results)} in {elapsed:.1f}s  ->  {len(results) / elapsed:.1f} req/s",
+        f"Latency ms: p50 {p50:.1f}  p90 {p90:.1f}  p95 {p95:.1f}  p99 {p99:.1f}  max {latency_ms.max():.1f}",
+        f"Decisions: {_mix([r[3] for r in results])}",
+        "",
+        "By scenario:",
+    ]
+    for scenario in sorted({r[2] for r in results}):
+        decisions = [r[3] for r in results if r[2] == scenario]
+        lines.append(f"  {scenario:<20} n={len(decisions):<7} {_mix(decisions)}")
+
+    lines += ["", f"Over time ({interval:g}s windows):"]
+    window = (finished // interval).astype(int)
+    for w in range(window.max() + 1):
+        idx = np.flatnonzero(window == w)
+        if len(idx) == 0:
+            continue
+        lines.append(
+            f"  t={w * interval:6.1f}s  {len(idx) / interval:8.1f} req/s  "
+            f"p99 {np.percentile(latency_ms[idx], 99):7.1f} ms  {_mix([results[i][3] for i in idx])}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the GART scoring path.")
+    parser.add_argument("--url", help="scoring_server.py or shard router base URL; scores in-process when omitted")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, help="stop after this many requests")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to run when --requests is not set")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--mix", type=json.loads, default=None,
+                        help='scenario draw weights as JSON (campaigns queue whole bursts), e.g. \'{"normal": 0.9, "credential_stuffing": 0.1}\'')
+    parser.add_argument("--interval", type=float, default=1.0, help="report window in seconds")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if args.url:
+        score = ScoringClient(args.url).score
+    else:
+        score = load_scorer().score
+
+    generator = TrafficGenerator(n_users=args.users, mix=args.mix, seed=args.seed)
+    results, elapsed = run_load(
+        score, generator, args.concurrency,
+        n_requests=args.requests, duration=None if args.requests else args.duration,
+    )
+    print(report(results, elapsed, args.interval))
@@ -0,0 +1,259 @@
+import argparse
+import json
+import os
+import shutil
+import time
+
+import joblib
+import numpy as np
+from scipy import sparse
+
+
+MODEL_FILE = "gart_model.pkl"
+MAPPED_MODEL_DIR = "gart_model_mmap"
+
+# Flat arrays of all trees, concatenated; tree t owns nodes offsets[t]:offsets[t + 1].
+ARRAYS = ["children_left", "children_right", "feature", "threshold", "value", "offsets"]
+
+
+class MappedForest:
+    """
+    Read-only RandomForest whose node arrays are memory-mapped .npy files.
+    Every process mapping the same files shares one page-cache copy, and
+    loading only maps the files instead of unpickling every tree.
+    """
+
+    def __init__(self, arrays: dict, classes):
+        self.children_left = arrays["children_left"]
+        self.children_right = arrays["children_right"]
+        self.feature = arrays["feature"]
+        self.threshold = arrays["threshold"]
+        self.value = arrays["value"]
+        self.offsets = arrays["offsets"]
+        self.classes_ = np.asarray(classes)
+        self.n_trees = len(self.offsets) - 1
+
+    def trees(self):
+        """
+        Per-tree (children_left, children_right, feature, value) with local
+        node ids, the layout of sklearn's tree_ attributes.
+        """
+        for t in range(self.n_trees):
+            lo, hi = self.offsets[t], self.offsets[t + 1]
+            left = np.where(self.children_left[lo:hi] >= 0, self.children_left[lo:hi] - lo, -1)
+            right = np.where(self.children_right[lo:hi] >= 0, self.children_right[lo:hi] - lo, -1)
+            yield left, right, self.feature[lo:hi], self.value[lo:hi][:, None, :]
+
+    def _leaves(self, X) -> np.ndarray:
+        # sklearn compares float32 inputs against float64 thresholds.
+        if sparse.issparse(X):
+            gather = _sparse_gather(X)
+            n = X.shape[0]
+        else:
+            X = np.asarray(X, dtype=np.float32)
+            gather = lambda r, c: X[r, c]
+            n = X.shape[0]
+
+        rows = np.repeat(np.arange(n), self.n_trees)
+        node = np.tile(self.offsets[:-1], n)
+        active = np.flatnonzero(self.children_left[node] >= 0)
+        # Every (row, tree) pair descends one level per step.
+        while len(active):
+            cur = node[active]
+            x = gather(rows[active], self.feature[cur])
+            node[active] = np.where(x <= self.threshold[cur], self.children_left[cur], self.children_right[cur])
+            active = active[self.children_left[node[active]] >= 0]
+        return node.reshape(n, self.n_trees)
+
+    def apply(self, X) -> np.ndarray:
+        """
+        Leaf index of every row in every tree, local to the tree (as sklearn).
+        """
+        return self._leaves(X) - self.offsets[:-1][None, :]
+
+    def predict_proba(self, X) -> np.ndarray:
+        return self.value[self._leaves(X)].mean(axis=1)
+
+
+def _sparse_gather(X):
+    """
+    Element lookup X[r, c] for a sparse matrix without densifying it: the
+    stored entries are addressed by the sorted key row * n_cols + col.
+    """
+    X = X.tocsr().astype(np.float32)
+    X.sort_indices()
+    keys = np.repeat(np.arange(X.shape[0], dtype=np.int64), np.diff(X.indptr)) * X.shape[1] + X.indices
+    data = X.data
+
+    def gather(r, c):
+        q = r.astype(np.int64) * X.shape[1] + c
+        pos = np.minimum(np.searchsorted(keys, q), max(len(keys) - 1, 0))
+        if not len(keys):
+            return np.zeros(len(q), dtype=np.float32)
+        return np.where(keys[pos] == q, data[pos], np.float32(0))
+    return gather
+
+
+class MappedPipeline:
+    """
+    Drop-in for the fitted Pipeline: the small preprocessing step is
+    unpickled, the forest is memory-mapped.
+    """
+
+    def __init__(self, preprocess, clf: MappedForest):
+        self.named_steps = {"preprocess": preprocess, "clf": clf}
+
+    def predict_proba(self, X):
+        return self.named_steps["clf"].predict_proba(self.named_steps["preprocess"].transform(X))
+
+
+def export_model(model, directory: str = MAPPED_MODEL_DIR, source_mtime: float = None):
+    """
+    Write the pipeline as preprocess.pkl plus one .npy per node array.
+    The new files are written to a temp dir and swapped in, so processes that
+    still map the old files keep reading a consistent copy.
+    """
+    clf = model.named_steps["clf"]
+    trees = [est.tree_ for est in clf.estimators_]
+    sizes = np.array([t.node_count for t in trees])
+    offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+
+    def shifted(children, lo):
+        return np.where(children >= 0, children + lo, -1)
+
+    value = np.concatenate([t.value[:, 0, :] for t in trees])
+    arrays = {
+        "children_left": np.concatenate([shifted(t.children_left, lo) for t, lo in zip(trees, offsets)]).astype(np.int32),
+        "children_right": np.concatenate([shifted(t.children_right, lo) for t, lo in zip(trees, offsets)]).astype(np.int32),
+        "feature": np.concatenate([t.feature for t in trees]).astype(np.int32),
+        "threshold": np.concatenate([t.threshold for t in trees]).astype(np.float64),
+        "value": value / value.sum(axis=1, keepdims=True),
+        "offsets": offsets,
+    }
+
+    tmp_dir = directory + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, arr in arrays.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(arr))
+    joblib.dump(model.named_steps["preprocess"], os.path.join(tmp_dir, "preprocess.pkl"))
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"classes": clf.classes_.tolist(), "source_mtime": source_mtime}, f)
+
+    old_dir = directory + ".old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(directory):
+        os.replace(directory, old_dir)
+    os.replace(tmp_dir, directory)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def load_mapped_model(directory: str = MAPPED_MODEL_DIR) -> MappedPipeline:
+    with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in ARRAYS}
+    preprocess = joblib.load(os.path.join(directory, "preprocess.pkl"))
+    return MappedPipeline(preprocess, MappedForest(arrays, meta["classes"]))
+
+
+def load_model(model_file: str = MODEL_FILE, directory: str = MAPPED_MODEL_DIR):
+    """
+    The mapped artifacts when they were exported from the current model
+    file, otherwise the pickled pipeline.
+    """
+    meta_path = os.path.join(directory, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path, encoding="utf-8") as f:
+            source_mtime = json.load(f).get("source_mtime")
+        if not os.path.exists(model_file) or source_mtime == os.path.getmtime(model_file):
+            return load_mapped_model(directory)
+    return joblib.load(model_file)
+
+
+def _memory_kb() -> dict:
+    """
+    RSS split and PSS of this process, in kB (Linux only). PSS charges shared
+    pages proportionally, so it shows what each worker really costs.
+    """
+    out = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key = line.split(":")[0]
+            if key in ("VmRSS", "RssAnon", "RssFile"):
+                out[key] = int(line.split()[1])
+    if os.path.exists("/proc/self/smaps_rollup"):
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    out["Pss"] = int(line.split()[1])
+    return out
+
+
+def _bench_worker(fmt, model_file, directory, sample, barrier, results):
+    # Import sklearn up front so both formats are measured without it.
+    import sklearn.compose, sklearn.ensemble, sklearn.pipeline, sklearn.preprocessing  # noqa: F401
+
+    before = _memory_kb()
+    start = time.perf_counter()
+    if fmt == "mmap":
+        model = load_mapped_model(directory)
+    else:
+        model = joblib.load(model_file)
+    model.predict_proba(sample)
+    load_s = time.perf_counter() - start
+    barrier.wait()
+    after = _memory_kb()
+    results.put({
+        "load_s": load_s,
+        "rss_delta_kb": after["VmRSS"] - before["VmRSS"],
+        "pss_kb": after.get("Pss", 0),
+    })
+    barrier.wait()
+
+
+def bench(workers=(1, 4, 16), model_file: str = MODEL_FILE, directory: str = MAPPED_MODEL_DIR,
+          sample_file: str = "gart_data.csv"):
+    """
+    Start N fresh worker processes per format, all holding the model at the
+    same time, and print mean load time, model RSS per worker and PSS.
+    """
+    import multiprocessing as mp
+    import pandas as pd
+
+    sample = pd.read_csv(sample_file).drop(columns="label").head(100)
+    ctx = mp.get_context("spawn")
+    print(f"{'format':<8}{'workers':>8}{'load ms':>10}{'model RSS/worker MB':>22}{'PSS/worker MB':>16}")
+    for fmt in ("pickle", "mmap"):
+        for n in workers:
+            barrier = ctx.Barrier(n)
+            results = ctx.Queue()
+            procs = [
+                ctx.Process(target=_bench_worker, args=(fmt, model_file, directory, sample, barrier, results))
+                for _ in range(n)
+            ]
+            for p in procs:
+                p.start()
+            rows = [results.get() for _ in range(n)]
+            for p in procs:
+                p.join()
+            print(
+                f"{fmt:<8}{n:>8}"
+                f"{np.mean([r['load_s'] for r in rows]) * 1000:>10.1f}"
+                f"{np.mean([r['rss_delta_kb'] for r in rows]) / 1024:>22.1f}"
+                f"{np.mean([r['pss_kb'] for r in rows]) / 1024:>16.1f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export / benchmark memory-mapped GART model artifacts.")
+    parser.add_argument("command", choices=["export", "bench"])
+    parser.add_argument("--model", default=MODEL_FILE)
+    parser.add_argument("--dir", default=MAPPED_MODEL_DIR)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_model(joblib.load(args.model), args.dir, source_mtime=os.path.getmtime(args.model))
+        print(f"Exported {args.model} to {args.dir}/")
+    else:
+        bench(args.workers, args.model, args.dir)
@@ -0,0 +1,170 @@
+import numpy as np
+import pandas as pd
+import joblib
+from sklearn.cluster import KMeans
+
+from scoring_state import STATE_SNAPSHOT_FILE, restore_state
+
+
+HISTORY_FILE = "gart_user_history.csv"
+PEER_BASELINES_FILE = "gart_peer_baselines.pkl"
+
+N_GROUPS = 8
+
+# Events a user needs before their own profile weighs as much as their group's.
+PRIOR_EVENTS = 5
+
+# Percentile of member-event distances used as the "fits this group" radius.
+RADIUS_PERCENTILE = 95
+
+
+def action_column(df: pd.DataFrame) -> str:
+    return "action_model" if "action_model" in df.columns else "action"
+
+
+def _one_hot(values, vocab) -> np.ndarray:
+    codes = pd.Categorical(values, categories=vocab).codes
+    out = np.zeros((len(codes), len(vocab)))
+    known = codes >= 0
+    out[np.flatnonzero(known), codes[known]] = 1.0
+    return out
+
+
+class PeerBaselines:
+    """
+    Compact per-group baselines and the centroids used to find the nearest
+    group. Lookups cost O(n_groups * n_features), independent of history size.
+    """
+
+    def __init__(self, countries, devices, actions, centroids, baselines, radius):
+        self.countries = list(countries)
+        self.devices = list(devices)
+        self.actions = list(actions)
+        self.centroids = np.asarray(centroids, dtype=float)
+        self.baselines = list(baselines)
+        self.radius = np.asarray(radius, dtype=float)
+
+    def event_vectors(self, events: pd.DataFrame) -> np.ndarray:
+        """
+        One row per event: country / device / action one-hots, hour on the
+        unit circle and scaled typing speed.
+        """
+        hour = events["hour"].astype(float).values
+        speed = events["typing_speed"].astype(float).values
+        return np.hstack([
+            _one_hot(events["country"].values, self.countries),
+            _one_hot(events["device"].values, self.devices),
+            _one_hot(events[action_column(events)].values, self.actions),
+            np.sin(2 * np.pi * hour / 24)[:, None],
+            np.cos(2 * np.pi * hour / 24)[:, None],
+            (speed / 10)[:, None],
+        ])
+
+    def nearest(self, events: pd.DataFrame):
+        """
+        Nearest group for the mean profile of `events` (a user's history).
+        Returns (group, distance).
+        """
+        return self.nearest_vector(self.event_vectors(events).mean(axis=0))
+
+    def nearest_vector(self, vector: np.ndarray):
+        """
+        Nearest group for a mean event vector, e.g. one kept incrementally
+        by scoring_state.UserProfiles. Returns (group, distance).
+        """
+        dists = self.distances(vector)
+        group = int(dists.argmin())
+        return group, float(dists[group])
+
+    def distances(self, vector: np.ndarray) -> np.ndarray:
+        """
+        Distance of a (mean) event vector to every group centroid.
+        """
+        return np.linalg.norm(self.centroids - vector, axis=1)
+
+    def shares(self) -> np.ndarray:
+        """
+        Each group's share of the users it was built from.
+        """
+        users = np.array([b["users"] for b in self.baselines], dtype=float)
+        return users / users.sum()
+
+    def save(self, path: str = PEER_BASELINES_FILE):
+        joblib.dump({
+            "countries": self.countries,
+            "devices": self.devices,
+            "actions": self.actions,
+            "centroids": self.centroids,
+            "baselines": self.baselines,
+            "radius": self.radius,
+        }, path)
+
+    @classmethod
+    def load(cls, path: str = PEER_BASELINES_FILE):
+        return cls(**joblib.load(path))
+
+
+def build_peer_baselines(profiles, events: pd.DataFrame, n_groups: int = N_GROUPS,
+                         random_state: int = 42) -> PeerBaselines:
+    """
+    Cluster users by their average behavior (country, device, action mix,
+    hour, typing speed) and keep one baseline per cluster. Profiles and
+    baselines come from the per-user aggregates of scoring_state.UserProfiles,
+    so users whose raw events were compacted away still count. The group
+    radius is measured on `events`, a sample of the users' own events such
+    as the recent-event buffers.
+    """
+    peers = PeerBaselines(
+        countries=sorted(profiles.vocab["country"], key=str),
+        devices=sorted(profiles.vocab["device"], key=str),
+        actions=sorted(profiles.vocab["action"], key=str),
+        centroids=np.empty((0, 0)),
+        baselines=[],
+        radius=[],
+    )
+
+    user_ids, n_events, vectors = profiles.peer_vectors(peers)
+    k = min(n_groups, len(user_ids))
+    km = KMeans(n_clusters=k, n_init=10, random_state=random_state).fit(vectors)
+    peers.centroids = km.cluster_centers_
+
+    events = events.dropna(subset=["user_id", "country", "device", "hour", "typing_speed"])
+    events = events[events["user_id"].astype(int).isin(user_ids)]
+    event_group = pd.Series(km.labels_, index=user_ids).loc[events["user_id"].astype(int)].to_numpy()
+    event_dist = np.linalg.norm(peers.event_vectors(events) - peers.centroids[event_group], axis=1)
+
+    baselines, radius = [], []
+    for g in range(k):
+        members = km.labels_ == g
+        baseline = profiles.group_baseline(user_ids[members])
+        baselines.append({
+            "country": baseline["country"],
+            "device": baseline["device"],
+            "action": baseline["action"],
+            "hour": float(baseline["hour"]),
+            "typing_speed": float(baseline["typing_speed"]),
+            "failed_logins": float(baseline["failed_logins"]),
+            "users": int(members.sum()),
+            "events": int(n_events[members].sum()),
+        })
+        dists = event_dist[event_group == g]
+        radius.append(float(np.percentile(dists, RADIUS_PERCENTILE)) if len(dists) else 0.0)
+
+    peers.baselines = baselines
+    peers.radius = np.asarray(radius)
+    return peers
+
+
+def own_weight(n_events: int, prior_events: int = PRIOR_EVENTS) -> float:
+    """
+    Weight of a user's own baseline vs. their peer group's: 0 with no
+    history, 0.5 at `prior_events` events, tending to 1 afterwards.
+    """
+    return n_events / (n_events + prior_events)
+
+
+if __name__ == "__main__":
+    state, _ = restore_state(HISTORY_FILE, STATE_SNAPSHOT_FILE)
+    peers = build_peer_baselines(state.profiles, state.recent.frame())
+    peers.save(PEER_BASELINES_FILE)
+    print(f"Saved {len(peers.baselines)} peer groups over {len(state.profiles.users)} users to {PEER_BASELINES_FILE}")
@@ -0,0 +1,236 @@
+import threading
+from collections import OrderedDict, deque
+from itertools import chain, islice
+
+import numpy as np
+import pandas as pd
+
+
+RECENT_CAPACITY = 1000
+RECENT_PER_USER = 50
+RECENT_USERS = 500
+
+
+class RecentEvents:
+    """
+    Fixed-size buffers of the newest events, filled on append, so the SOC
+    tables never sort the history.
+
+    Besides the global buffer there is one per level, per decision and per
+    (level, decision) pair, each holding the newest `capacity` events of that
+    kind, and one per user holding that user's newest `per_user` events.
+    A filtered page therefore reads only the rows it shows.
+
+    Only the `max_users` most recently active users keep a buffer; the least
+    recently active one is evicted when a new user arrives (and starts a
+    fresh buffer if they become active again). At most
+    capacity * (number of buffers) + max_users * per_user rows are stored,
+    however long the history.
+
+    Buffers hold sequence numbers (arrival order); the rows themselves are
+    kept once in DataFrame chunks and only turned into records for a page.
+    """
+
+    def __init__(self, capacity: int = RECENT_CAPACITY, per_user: int = RECENT_PER_USER,
+                 max_users: int = RECENT_USERS):
+        self.capacity = capacity
+        self.per_user = per_user
+        self.max_users = max_users
+        self.lock = threading.Lock()
+        self._index = {}
+        # Least recently active user first.
+        self._users = OrderedDict()
+        self._chunks = []
+        self._stored = 0
+        self._live_after_compact = 0
+        self._seq = 0
+
+    def _buffer(self, key) -> deque:
+        buf = self._index.get(key)
+        if buf is None:
+            buf = self._index[key] = deque(maxlen=self.capacity)
+        return buf
+
+    def _user_buffer(self, uid: int) -> deque:
+        buf = self._users.get(uid)
+        if buf is None:
+            buf = self._users[uid] = deque(maxlen=self.per_user)
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(uid)
+        return buf
+
+    def config(self) -> tuple:
+        return self.capacity, self.per_user, self.max_users
+
+    def append(self, record: dict):
+        self.add_history(pd.DataFrame([record]), sort=False)
+
+    def add_history(self, history: pd.DataFrame, sort: bool = True):
+        """
+        Add a history frame, oldest first (sorted by timestamp unless
+        sort=False). Only rows that end up in some buffer are stored, so
+        seeding from a long history stays cheap.
+        """
+        if history.empty:
+            return
+        if sort:
+            history = history.sort_values("timestamp", kind="stable")
+        history = history.reset_index(drop=True)
+        n = len(history)
+
+        level_codes, levels = pd.factorize(history["level"])
+        decision_codes, decisions = pd.factorize(history["decision"])
+        tails = {(None, None): np.arange(max(n - self.capacity, 0), n)}
+        for li, level in enumerate(levels):
+            tails[(level, None)] = np.flatnonzero(level_codes == li)[-self.capacity:]
+        for di, decision in enumerate(decisions):
+            tails[(None, decision)] = np.flatnonzero(decision_codes == di)[-self.capacity:]
+            for li, level in enumerate(levels):
+                idx = np.flatnonzero((level_codes == li) & (decision_codes == di))[-self.capacity:]
+                if len(idx):
+                    tails[(level, decision)] = idx
+
+        # Last `per_user` rows of every user: a stable sort by user keeps time order.
+        uids = history["user_id"].astype(int).to_numpy()
+        order = np.argsort(uids, kind="stable")
+        sorted_uids = uids[order]
+        starts = np.flatnonzero(np.r_[True, sorted_uids[1:] != sorted_uids[:-1]])
+        ends = np.r_[starts[1:], n]
+        # Touch users in order of their last event, and skip those that would
+        # be evicted again within this frame.
+        by_last = np.argsort(order[ends - 1], kind="stable")[-self.max_users:]
+        user_tails = [
+            (int(sorted_uids[starts[i]]), order[max(starts[i], ends[i] - self.per_user):ends[i]])
+            for i in by_last
+        ]
+
+        needed = np.unique(np.concatenate(list(tails.values()) + [idx for _, idx in user_tails]))
+        with self.lock:
+            base = self._seq
+            self._seq += n
+            self._chunks.append((needed + base, history.iloc[needed].reset_index(drop=True)))
+            self._stored += len(needed)
+            for key, idx in tails.items():
+                self._buffer(key).extend((idx + base).tolist())
+            for uid, idx in user_tails:
+                self._user_buffer(uid).extend((idx + base).tolist())
+            if self._stored > 2 * max(self._live_after_compact, self.capacity):
+                self._compact()
+
+    def _live(self) -> np.ndarray:
+        return np.unique(np.fromiter(
+            chain.from_iterable(chain(self._index.values(), self._users.values())), dtype=np.int64,
+        ))
+
+    def _compact(self):
+        # Drop rows no buffer refers to any more.
+        live = self._live()
+        self._chunks = [(live, self._rows(live))]
+        self._stored = self._live_after_compact = len(live)
+
+    def _rows(self, seqs) -> pd.DataFrame:
+        """
+        Stored rows for `seqs`, in that order.
+        """
+        seqs = np.asarray(seqs, dtype=np.int64)
+        if not len(seqs):
+            return self._chunks[0][1].iloc[:0] if self._chunks else pd.DataFrame()
+        firsts = np.array([chunk_seqs[0] for chunk_seqs, _ in self._chunks])
+        chunk_of = np.searchsorted(firsts, seqs, side="right") - 1
+        parts, positions = [], []
+        for c in np.unique(chunk_of):
+            sel = np.flatnonzero(chunk_of == c)
+            chunk_seqs, frame = self._chunks[c]
+            parts.append(frame.iloc[np.searchsorted(chunk_seqs, seqs[sel])])
+            positions.append(sel)
+        rows = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0].reset_index(drop=True)
+        return rows.iloc[np.argsort(np.concatenate(positions))].reset_index(drop=True)
+
+    def count(self, level: str = None, decision: str = None, user_id=None) -> int:
+        return self.page(0, 0, level, decision, user_id)[1]
+
+    def page(self, page: int = 0, page_size: int = 50, level: str = None, decision: str = None,
+             user_id=None) -> tuple:
+        """
+        Returns (records newest first, number of buffered matches) for one
+        page, optionally limited to a level, a decision and/or one user.
+        """
+        start = page * page_size
+        with self.lock:
+            if user_id is not None:
+                rows = self._rows(list(reversed(self._users.get(int(user_id), ()))))
+                if not rows.empty:
+                    if level is not None:
+                        rows = rows[rows["level"] == level]
+                    if decision is not None:
+                        rows = rows[rows["decision"] == decision]
+                return _records(rows.iloc[start:start + page_size]), len(rows)
+            buf = self._index.get((level, decision), ())
+            rows = self._rows(list(islice(reversed(buf), start, start + page_size)))
+            return _records(rows), len(buf)
+
+    def frame(self) -> pd.DataFrame:
+        """
+        Every buffered row, oldest first.
+        """
+        with self.lock:
+            return self._rows(self._live())
+
+    def user_ids(self) -> list:
+        """
+        The users that currently have a buffer, i.e. the `max_users` most
+        recently active ones.
+        """
+        with self.lock:
+            return sorted(self._users)
+
+    def to_snapshot(self, exclude_newest: int = 0) -> dict:
+        """
+        Buffers as sequence arrays plus the rows they refer to, for
+        scoring_state snapshots. The newest `exclude_newest` rows are left
+        out, e.g. rows appended before they reached the history file.
+        """
+        with self.lock:
+            cutoff = self._seq - exclude_newest
+            index = {key: np.array(buf, dtype=np.int64) for key, buf in self._index.items()}
+            index = {key: seqs[seqs < cutoff] for key, seqs in index.items()}
+            users = {uid: np.array(buf, dtype=np.int64) for uid, buf in self._users.items()}
+            users = {uid: seqs[seqs < cutoff] for uid, seqs in users.items()}
+            users = {uid: seqs for uid, seqs in users.items() if len(seqs)}
+            live = np.unique(np.concatenate([np.zeros(0, dtype=np.int64), *index.values(), *users.values()]))
+            return {
+                "capacity": self.capacity,
+                "per_user": self.per_user,
+                "max_users": self.max_users,
+                "seq": cutoff,
+                "seqs": live,
+                "rows": self._rows(live),
+                "index": index,
+                "user_ids": np.array(list(users), dtype=np.int64),
+                "user_lengths": np.array([len(seqs) for seqs in users.values()], dtype=np.int64),
+                "user_seqs": np.concatenate([np.zeros(0, dtype=np.int64), *users.values()]),
+            }
+
+    @classmethod
+    def from_snapshot(cls, snapshot: dict) -> "RecentEvents":
+        recent = cls(snapshot["capacity"], snapshot["per_user"], snapshot.get("max_users", RECENT_USERS))
+        recent._seq = snapshot["seq"]
+        if len(snapshot["seqs"]):
+            recent._chunks = [(snapshot["seqs"], snapshot["rows"])]
+        recent._stored = recent._live_after_compact = len(snapshot["seqs"])
+        for key, seqs in snapshot["index"].items():
+            recent._index[key] = deque(seqs.tolist(), maxlen=recent.capacity)
+        split = np.cumsum(snapshot["user_lengths"])[:-1]
+        for uid, seqs in zip(snapshot["user_ids"].tolist(), np.split(snapshot["user_seqs"], split)):
+            recent._users[uid] = deque(seqs.tolist(), maxlen=recent.per_user)
+        while len(recent._users) > recent.max_users:
+            recent._users.popitem(last=False)
+        return recent
+
+
+def _records(frame: pd.DataFrame) -> list:
+    # Column-wise tolist() yields plain Python values much faster than to_dict().
+    columns = list(frame.columns)
+    return [dict(zip(columns, values)) for values in zip(*(frame[c].tolist() for c in columns))]
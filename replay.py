@@ -0,0 +1,180 @@
+"""
+What-if replay of the final-risk blend and decision thresholds over the
+stored history.
+
+The final score only depends on the (model_risk, behavior_risk) pair, and
+both are integers in 0..100. The history is therefore reduced once, in
+chunks, to a 101 x 101 histogram of pairs. Every weight and threshold
+configuration is then evaluated on that histogram. Runtime after the
+single read does not depend on the number of events.
+
+Rows compacted out of the history (see scoring_state.compact_history_file)
+are included through the histogram kept in its compacted state file, so
+the replay still covers the whole history, not only the raw retention.
+
+    python replay.py
+    python replay.py --model-weights 0.4 0.5 0.6 0.7 --low 20 25 30 --medium 50 60 70 --out grid.csv
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from rollups import RISK_VALUES, risk_pair_histogram
+from scoring import BEHAVIOR_WEIGHT, LOW_RISK_MAX, MEDIUM_RISK_MAX, MODEL_WEIGHT
+from scoring_state import compacted_file, load_compacted
+
+
+HISTORY_FILE = "gart_user_history.csv"
+
+
+def risk_histogram(path: str = HISTORY_FILE, chunksize: int = 1_000_000):
+    """
+    Returns (hist, first_timestamp, last_timestamp) where hist[m, b] counts
+    raw events of `path` with model_risk m and behavior_risk b. Memory stays
+    bounded by `chunksize` whatever the history size.
+    """
+    hist = np.zeros((RISK_VALUES, RISK_VALUES), dtype=np.int64)
+    first_ts, last_ts = None, None
+    reader = pd.read_csv(
+        path, usecols=["timestamp", "model_risk", "behavior_risk"],
+        dtype={"timestamp": str}, chunksize=chunksize,
+    )
+    for chunk in reader:
+        hist += risk_pair_histogram(chunk)
+
+        # "%Y-%m-%d %H:%M:%S" strings sort chronologically.
+        ts = chunk["timestamp"].dropna()
+        if not ts.empty:
+            first_ts = ts.min() if first_ts is None else min(first_ts, ts.min())
+            last_ts = ts.max() if last_ts is None else max(last_ts, ts.max())
+    return hist, first_ts, last_ts
+
+
+def full_risk_histogram(path: str = HISTORY_FILE, chunksize: int = 1_000_000):
+    """
+    risk_histogram of the raw rows plus the rows compacted out of `path`.
+    Returns (hist, first_timestamp, last_timestamp, compacted_events,
+    missing) where `missing` counts compacted events that were folded in
+    before the compacted state kept a risk histogram and so are not in it.
+    """
+    hist, first_ts, last_ts = risk_histogram(path, chunksize)
+    archive = load_compacted(path)
+    compacted = int(archive.risk_pairs.sum())
+    hist = hist + archive.risk_pairs
+    for ts in (archive.first_timestamp, archive.last_timestamp):
+        if ts is not None:
+            first_ts = ts if first_ts is None else min(first_ts, ts)
+            last_ts = ts if last_ts is None else max(last_ts, ts)
+    return hist, first_ts, last_ts, compacted, archive.events - compacted
+
+
+def final_risk_histograms(hist: np.ndarray, weight_pairs: np.ndarray) -> np.ndarray:
+    """
+    For each (model_weight, behavior_weight) pair, the histogram of
+    min(100, int(mw * model_risk + bw * behavior_risk)) over all events.
+    Returns shape (n_pairs, 101).
+    """
+    risk = np.arange(RISK_VALUES, dtype=np.float64)
+    mw = weight_pairs[:, 0][:, None, None]
+    bw = weight_pairs[:, 1][:, None, None]
+    # Same float64 expression as scoring.score_attempt, truncated like int().
+    final = np.minimum(100, np.trunc(mw * risk[None, :, None] + bw * risk[None, None, :])).astype(np.int64)
+
+    n_pairs = len(weight_pairs)
+    offsets = (np.arange(n_pairs) * RISK_VALUES)[:, None, None]
+    weights = np.broadcast_to(hist, final.shape)
+    return np.bincount(
+        (final + offsets).ravel(), weights=weights.ravel(), minlength=n_pairs * RISK_VALUES
+    ).reshape(n_pairs, RISK_VALUES)
+
+
+def evaluate_grid(hist: np.ndarray, model_weights, behavior_weights, lows, mediums,
+                  days: float = None) -> pd.DataFrame:
+    """
+    Allow / Challenge / Block mix for every weight pair and every
+    low < medium threshold pair. Allow is final < low, Challenge is
+    final < medium, Block otherwise, as in scoring.risk_level.
+    """
+    if behavior_weights is None:
+        pairs = np.array([(w, 1 - w) for w in model_weights])
+    else:
+        pairs = np.array([(w, v) for w in model_weights for v in behavior_weights])
+    lows = np.asarray(lows, dtype=np.int64)
+    mediums = np.asarray(mediums, dtype=np.int64)
+
+    finals = final_risk_histograms(hist, pairs)
+    # below[p, k] = events with final risk < k
+    below = np.concatenate([np.zeros((len(pairs), 1)), np.cumsum(finals, axis=1)], axis=1)
+    total = below[:, -1:]
+
+    p_idx, l_idx, m_idx = np.meshgrid(np.arange(len(pairs)), np.arange(len(lows)), np.arange(len(mediums)), indexing="ij")
+    p_idx, l_idx, m_idx = p_idx.ravel(), l_idx.ravel(), m_idx.ravel()
+    valid = lows[l_idx] < mediums[m_idx]
+    p_idx, l_idx, m_idx = p_idx[valid], l_idx[valid], m_idx[valid]
+
+    low_k = np.clip(lows[l_idx], 0, RISK_VALUES)
+    med_k = np.clip(mediums[m_idx], 0, RISK_VALUES)
+    allow = below[p_idx, low_k]
+    challenge = below[p_idx, med_k] - allow
+    block = total[p_idx, 0] - below[p_idx, med_k]
+    n = np.maximum(total[p_idx, 0], 1)
+
+    result = pd.DataFrame({
+        "model_weight": pairs[p_idx, 0],
+        "behavior_weight": pairs[p_idx, 1],
+        "low_max": lows[l_idx],
+        "medium_max": mediums[m_idx],
+        "allow_pct": allow / n * 100,
+        "challenge_pct": challenge / n * 100,
+        "block_pct": block / n * 100,
+        "challenges": challenge.astype(np.int64),
+    })
+    if days:
+        result["challenges_per_day"] = challenge / days
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay stored risks under other blend weights and thresholds.")
+    parser.add_argument("--history", default=HISTORY_FILE)
+    parser.add_argument("--model-weights", type=float, nargs="+", default=np.round(np.arange(0, 1.0001, 0.05), 2).tolist())
+    parser.add_argument("--behavior-weights", type=float, nargs="+",
+                        help="behavior weights to cross with the model weights (default: 1 - model weight)")
+    parser.add_argument("--low", type=int, nargs="+", default=list(range(10, 55, 5)), help="LOW upper bounds (exclusive)")
+    parser.add_argument("--medium", type=int, nargs="+", default=list(range(40, 95, 5)), help="MEDIUM upper bounds (exclusive)")
+    parser.add_argument("--out", help="write the full grid to this CSV")
+    parser.add_argument("--top", type=int, default=15, help="rows to print, lowest challenge load first")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    hist, first_ts, last_ts, compacted, missing = full_risk_histogram(args.history)
+    read_s = time.perf_counter() - start
+
+    days = None
+    if first_ts is not None:
+        days = max((pd.Timestamp(last_ts) - pd.Timestamp(first_ts)) / pd.Timedelta(days=1), 1.0)
+
+    start = time.perf_counter()
+    grid = evaluate_grid(hist, args.model_weights, args.behavior_weights, args.low, args.medium, days)
+    eval_s = time.perf_counter() - start
+
+    print(f"{int(hist.sum())} events ({first_ts} – {last_ts}), read in {read_s:.2f}s; "
+          f"{len(grid)} configurations evaluated in {eval_s * 1000:.1f} ms")
+    if compacted:
+        print(f"{compacted} of them were compacted out of {args.history} and come from {compacted_file(args.history)}")
+    if missing:
+        print(f"Warning: {missing} compacted events predate the risk histogram in "
+              f"{compacted_file(args.history)} and are not included")
+
+    current = evaluate_grid(hist, [MODEL_WEIGHT], [BEHAVIOR_WEIGHT], [LOW_RISK_MAX], [MEDIUM_RISK_MAX], days)
+    pd.set_option("display.width", 200)
+    print("\nCurrent configuration:")
+    print(current.round(2).to_string(index=False))
+    print(f"\nLowest challenge load ({args.top} of {len(grid)}):")
+    print(grid.sort_values(["challenges", "block_pct"]).head(args.top).round(2).to_string(index=False))
+
+    if args.out:
+        grid.to_csv(args.out, index=False)
+        print(f"\nSaved full grid to {args.out}")
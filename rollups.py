@@ -0,0 +1,500 @@
+import logging
+import os
+import threading
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+
+ROLLUP_DIR = "gart_rollups"
+
+RESOLUTIONS = {
+    "minute": pd.Timedelta(minutes=1),
+    "hour": pd.Timedelta(hours=1),
+    "day": pd.Timedelta(days=1),
+}
+
+# How long each resolution is kept. Day rollups are kept forever so the
+# all-time counters always have a source once raw events are compacted.
+ROLLUP_RETENTION = {
+    "minute": pd.Timedelta(days=2),
+    "hour": pd.Timedelta(days=90),
+    "day": None,
+}
+
+# Per-user tables hold about one row per event for occasional users, so
+# they are kept for less time. All-time counters per user are kept in the
+# user totals instead, one row per user.
+USER_ROLLUP_RETENTION = {
+    "minute": pd.Timedelta(days=1),
+    "hour": pd.Timedelta(days=30),
+    "day": pd.Timedelta(days=365),
+}
+
+# Tables are persisted in one file per partition: minute buckets per day,
+# hour buckets per month, day buckets per year. Partition names sort in time
+# order. User totals are split by user_id modulo USER_TOTAL_PARTITIONS on disk
+# and kept as one frame indexed by user_id in memory.
+PARTITIONS = {"minute": "%Y-%m-%d", "hour": "%Y-%m", "day": "%Y"}
+USER_TOTAL_PARTITIONS = 64
+
+# A resolution is only picked for a query if it yields at least this many
+# points over the requested range (otherwise the chart is a single dot).
+MIN_POINTS = 12
+
+DECISIONS = ["Allow", "Challenge", "Block"]
+LEVELS = ["LOW", "MEDIUM", "HIGH"]
+
+COUNT_COLS = (
+    ["count"]
+    + [d.lower() for d in DECISIONS]
+    + [l.lower() for l in LEVELS]
+    + ["risk_sum"]
+)
+AGG = {**{c: "sum" for c in COUNT_COLS}, "risk_max": "max"}
+
+# model_risk and behavior_risk are integers in 0..RISK_VALUES - 1.
+RISK_VALUES = 101
+
+
+def aggregate_events(events: pd.DataFrame, resolution: str, by_user: bool = False) -> pd.DataFrame:
+    """
+    Aggregate raw history events into buckets of the given resolution.
+    Returns one row per bucket (and per user_id when by_user is True) with
+    counts by decision and level, the sum and the max of final_risk.
+    """
+    return _aggregate_frame(_event_frame(events), resolution, by_user)
+
+
+def _event_frame(events: pd.DataFrame) -> pd.DataFrame:
+    """
+    One row of counters per event with its parsed timestamp and user_id,
+    shared by the aggregations of all resolutions.
+    """
+    if events.empty:
+        return pd.DataFrame(columns=["ts", "user_id"] + list(AGG))
+
+    ts = pd.to_datetime(events["timestamp"], errors="coerce")
+    frame = pd.DataFrame({"ts": ts.values, "count": 1})
+    frame["user_id"] = pd.to_numeric(events["user_id"], errors="coerce").fillna(0).astype(int).values
+    for d in DECISIONS:
+        frame[d.lower()] = (events["decision"] == d).astype(int).values
+    for l in LEVELS:
+        frame[l.lower()] = (events["level"] == l).astype(int).values
+    risk = pd.to_numeric(events["final_risk"], errors="coerce").fillna(0).values
+    frame["risk_sum"] = risk
+    frame["risk_max"] = risk
+    return frame.dropna(subset=["ts"])
+
+
+def _aggregate_frame(frame: pd.DataFrame, resolution: str, by_user: bool) -> pd.DataFrame:
+    keys = ["bucket", "user_id"] if by_user else ["bucket"]
+    if frame.empty:
+        return pd.DataFrame(columns=keys + list(AGG))
+    frame = frame.assign(bucket=frame["ts"].dt.floor(RESOLUTIONS[resolution]))
+    return _aggregate(frame, keys).reset_index()
+
+
+def _aggregate(frame: pd.DataFrame, keys) -> pd.DataFrame:
+    """
+    Sum the counters and max risk_max of `frame` per `keys`, indexed by them.
+    Same as groupby(keys).agg(AGG), which is several times slower on the
+    small frames of a flush.
+    """
+    grouped = frame.groupby(keys, sort=False)
+    out = grouped[COUNT_COLS].sum()
+    out["risk_max"] = grouped["risk_max"].max()
+    return out
+
+
+def risk_pair_histogram(events: pd.DataFrame) -> np.ndarray:
+    """
+    101 x 101 counts of (model_risk, behavior_risk) pairs in raw history
+    events. The final risk and decision of any blend / threshold setting
+    only depend on that pair, so replay.py can evaluate them on this
+    histogram after the raw events are compacted away.
+    """
+    m = pd.to_numeric(events["model_risk"], errors="coerce")
+    b = pd.to_numeric(events["behavior_risk"], errors="coerce")
+    ok = (m.notna() & b.notna()).to_numpy()
+    m = m.to_numpy()[ok].astype(np.int64).clip(0, RISK_VALUES - 1)
+    b = b.to_numpy()[ok].astype(np.int64).clip(0, RISK_VALUES - 1)
+    hist = np.bincount(m * RISK_VALUES + b, minlength=RISK_VALUES * RISK_VALUES)
+    return hist.reshape(RISK_VALUES, RISK_VALUES)
+
+
+def merge_rollups(current: pd.DataFrame, new: pd.DataFrame, by_user: bool = False) -> pd.DataFrame:
+    """
+    Combine two rollup tables of the same resolution. Sums and maxes are
+    associative, so merging partial aggregates gives the same result as
+    aggregating all raw events at once. Only the buckets present in `new`
+    are re-aggregated; rows are not kept in bucket order.
+    """
+    return _merge(current, new, ["bucket", "user_id"] if by_user else ["bucket"])
+
+
+def _merge(current: pd.DataFrame, new: pd.DataFrame, keys) -> pd.DataFrame:
+    if current is None or current.empty:
+        return new.reset_index(drop=True)
+    if new.empty:
+        return current
+    # Only rows sharing the first key (bucket, or user for the totals) with
+    # `new` can change.
+    touched = current[keys[0]].isin(new[keys[0]].unique())
+    if touched.any():
+        new = _aggregate(pd.concat([current[touched], new], ignore_index=True), keys).reset_index()
+        current = current[~touched]
+    return pd.concat([current, new], ignore_index=True)
+
+
+def _merge_totals(current: pd.DataFrame, new: pd.DataFrame) -> pd.DataFrame:
+    """
+    Add per-user totals indexed by user_id into `current`, in place for the
+    users it already has.
+    """
+    if current is None or current.empty:
+        return new.copy()
+    seen = new.index.isin(current.index)
+    old = new.index[seen]
+    if len(old):
+        current.loc[old, COUNT_COLS] += new.loc[old, COUNT_COLS]
+        current.loc[old, "risk_max"] = np.maximum(current.loc[old, "risk_max"], new.loc[old, "risk_max"])
+    if seen.all():
+        return current
+    return pd.concat([current, new[~seen]])
+
+
+class RollupStore:
+    """
+    Minute / hour / day aggregates of the history log, globally and per user,
+    plus all-time counters per user (one row per user).
+
+    Every table is split into partitions (PARTITIONS) persisted as one CSV
+    each inside `directory`. A batch of new events only re-aggregates the
+    buckets it touches, and save() only rewrites the partitions that changed
+    since the last save. `position` is the history position the rollups
+    cover, saved with them, so a start can fold in the rows written after
+    the last save.
+    """
+
+    def __init__(self, directory: str = ROLLUP_DIR):
+        self.directory = directory
+        self.tables = {}
+        self.user_totals = None
+        self.position = None
+        # Set when a batch could not be folded in. The store then keeps
+        # serving but stops saving, so the next start replays from the last
+        # saved position instead of skipping that batch for good.
+        self.stale = False
+        self._dirty = set()
+        self._removed = set()
+        self._legacy = []
+        self._lock = threading.Lock()
+        self._saved_at = time.monotonic()
+
+    def _table_dir(self, resolution: str, by_user: bool) -> str:
+        suffix = "_users" if by_user else ""
+        return os.path.join(self.directory, f"{resolution}{suffix}")
+
+    def _path(self, key) -> str:
+        if key[0] == "user_totals":
+            return os.path.join(self.directory, "user_totals", f"{key[1]}.csv")
+        resolution, by_user, part = key
+        return os.path.join(self._table_dir(resolution, by_user), f"{part}.csv")
+
+    def _position_path(self) -> str:
+        return os.path.join(self.directory, "position.pkl")
+
+    def load(self) -> bool:
+        """
+        Load the persisted rollups. Returns False if none exist yet, in which
+        case the caller should bootstrap them from the raw history.
+        """
+        found = False
+        with self._lock:
+            for resolution in RESOLUTIONS:
+                for by_user in (False, True):
+                    table_dir = self._table_dir(resolution, by_user)
+                    legacy = os.path.join(self.directory, f"rollup_{resolution}{'_users' if by_user else ''}.csv")
+                    table = {}
+                    if os.path.isdir(table_dir):
+                        for name in sorted(os.listdir(table_dir)):
+                            if name.endswith(".csv"):
+                                table[name[:-4]] = pd.read_csv(os.path.join(table_dir, name), parse_dates=["bucket"])
+                        found = True
+                    elif os.path.exists(legacy):
+                        # Single-file layout from before partitioning; split
+                        # up on the next save.
+                        df = pd.read_csv(legacy, parse_dates=["bucket"])
+                        for part, rows in _partitions(df, resolution):
+                            table[part] = rows
+                            self._dirty.add((resolution, by_user, part))
+                        if by_user and resolution == "day":
+                            self.user_totals = _user_totals(df)
+                            self._dirty |= {("user_totals", part) for part in _user_partitions(self.user_totals)}
+                        self._legacy.append(legacy)
+                        found = True
+                    self.tables[(resolution, by_user)] = table
+
+            totals_dir = os.path.join(self.directory, "user_totals")
+            if os.path.isdir(totals_dir):
+                parts = [
+                    pd.read_csv(os.path.join(totals_dir, name), index_col="user_id")
+                    for name in sorted(os.listdir(totals_dir))
+                    if name.endswith(".csv")
+                ]
+                if parts:
+                    self.user_totals = pd.concat(parts)
+
+            if os.path.exists(self._position_path()):
+                self.position = joblib.load(self._position_path())
+        return found
+
+    def save(self) -> bool:
+        """
+        Write the partitions changed since the last save, then the position
+        they cover. Returns False if the store is stale and was not saved.
+        """
+        if self.stale:
+            logger.error("Rollups missed a batch of events; not saving them, the next start replays the history")
+            self._saved_at = time.monotonic()
+            return False
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            removed, self._removed = self._removed, set()
+            frames = {key: self._partition(key) for key in dirty}
+            position = self.position
+            self._saved_at = time.monotonic()
+        try:
+            for key, df in frames.items():
+                path = self._path(key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                df.to_csv(path + ".tmp", index=key[0] == "user_totals")
+                os.replace(path + ".tmp", path)
+            for key in removed:
+                if os.path.exists(self._path(key)):
+                    os.remove(self._path(key))
+            os.makedirs(self.directory, exist_ok=True)
+            joblib.dump(position, self._position_path() + ".tmp")
+            os.replace(self._position_path() + ".tmp", self._position_path())
+            for legacy in self._legacy:
+                if os.path.exists(legacy):
+                    os.remove(legacy)
+            self._legacy = []
+        except Exception:
+            with self._lock:
+                self._dirty |= dirty
+                self._removed |= removed
+            raise
+        return True
+
+    def save_if_due(self, interval: float) -> bool:
+        """
+        Prune and save if the last save is more than `interval` seconds ago.
+        """
+        if time.monotonic() - self._saved_at < interval:
+            return False
+        self.prune()
+        return self.save()
+
+    def _partition(self, key) -> pd.DataFrame:
+        if key[0] == "user_totals":
+            ids = self.user_totals.index.to_numpy()
+            return self.user_totals[ids % USER_TOTAL_PARTITIONS == int(key[1])].copy()
+        return self.tables[key[:2]][key[2]]
+
+    def add_events(self, events: pd.DataFrame, position: dict = None):
+        """
+        Fold new raw events into every resolution and the per-user totals.
+        `position` is the history position after these events.
+        """
+        try:
+            frame = _event_frame(events)
+            updates = {
+                (resolution, by_user): _aggregate_frame(frame, resolution, by_user)
+                for resolution in RESOLUTIONS
+                for by_user in (False, True)
+            }
+            totals = _user_totals(updates[("day", True)])
+            with self._lock:
+                for (resolution, by_user), new in updates.items():
+                    table = self.tables.setdefault((resolution, by_user), {})
+                    for part, rows in _partitions(new, resolution):
+                        table[part] = merge_rollups(table.get(part), rows, by_user=by_user)
+                        self._dirty.add((resolution, by_user, part))
+                        self._removed.discard((resolution, by_user, part))
+                if not totals.empty:
+                    self.user_totals = _merge_totals(self.user_totals, totals)
+                    self._dirty |= {("user_totals", part) for part in _user_partitions(totals)}
+                if position is not None:
+                    self.position = position
+        except Exception:
+            self.stale = True
+            raise
+
+    def prune(self, now=None):
+        """
+        Drop buckets older than the retention of their resolution (see
+        ROLLUP_RETENTION and USER_ROLLUP_RETENTION).
+        """
+        now = pd.Timestamp(now) if now is not None else pd.Timestamp.now()
+        with self._lock:
+            for (resolution, by_user), table in self.tables.items():
+                keep_for = _retention(resolution, by_user)
+                if keep_for is None:
+                    continue
+                cutoff = now - keep_for
+                first_kept = cutoff.strftime(PARTITIONS[resolution])
+                for part in [p for p in table if p <= first_kept]:
+                    df = table[part]
+                    old = df["bucket"] < cutoff
+                    key = (resolution, by_user, part)
+                    if old.all():
+                        del table[part]
+                        self._dirty.discard(key)
+                        self._removed.add(key)
+                    elif old.any():
+                        table[part] = df[~old].reset_index(drop=True)
+                        self._dirty.add(key)
+
+    def _frame(self, resolution: str, by_user: bool, user_id=None, start=None) -> pd.DataFrame:
+        """
+        One table as a frame, limited to the partitions from `start` on and
+        to one user.
+        """
+        with self._lock:
+            table = self.tables.get((resolution, by_user), {})
+            first = pd.Timestamp(start).strftime(PARTITIONS[resolution]) if start is not None else ""
+            parts = [table[p] for p in sorted(table) if p >= first]
+        keys = ["bucket", "user_id"] if by_user else ["bucket"]
+        if not parts:
+            return pd.DataFrame(columns=keys + list(AGG))
+        df = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+        if user_id is not None:
+            df = df[df["user_id"] == user_id]
+        return df
+
+    def choose_resolution(self, start, end, now=None, by_user: bool = False) -> str:
+        """
+        Pick the coarsest resolution that still gives MIN_POINTS buckets over
+        [start, end] and whose retention covers `start`.
+        """
+        now = pd.Timestamp(now) if now is not None else pd.Timestamp.now()
+        span = pd.Timestamp(end) - pd.Timestamp(start)
+        for resolution in ["day", "hour", "minute"]:
+            keep_for = _retention(resolution, by_user)
+            if keep_for is not None and pd.Timestamp(start) < now - keep_for:
+                continue
+            if span / RESOLUTIONS[resolution] >= MIN_POINTS:
+                return resolution
+
+        # Short range: use the finest resolution still retained for it.
+        for resolution in ["minute", "hour", "day"]:
+            keep_for = _retention(resolution, by_user)
+            if keep_for is None or pd.Timestamp(start) >= now - keep_for:
+                return resolution
+        return "day"
+
+    def query(self, start=None, end=None, user_id=None, resolution=None) -> pd.DataFrame:
+        """
+        Return the rollup rows for [start, end], globally or for one user,
+        with an extra `mean_risk` column. When no resolution is given the
+        coarsest one that fits the range is used. Missing bounds default to
+        the first recorded bucket and now.
+        """
+        by_user = user_id is not None
+        day = self._frame("day", by_user, user_id)
+        if day.empty:
+            return pd.DataFrame(columns=["bucket"] + list(AGG) + ["mean_risk"])
+
+        start = pd.Timestamp(start) if start is not None else day["bucket"].min()
+        end = pd.Timestamp(end) if end is not None else pd.Timestamp.now()
+        if resolution is None:
+            resolution = self.choose_resolution(start, end, by_user=by_user)
+
+        df = self._frame(resolution, by_user, user_id, start)
+        df = df[(df["bucket"] >= pd.Timestamp(start).floor(RESOLUTIONS[resolution])) & (df["bucket"] <= end)]
+        df = df.sort_values("bucket").reset_index(drop=True)
+        df["mean_risk"] = df["risk_sum"] / df["count"].clip(lower=1)
+        return df
+
+    def totals(self, user_id=None) -> pd.Series:
+        """
+        All-time counters (count, per decision, per level, risk_sum, risk_max),
+        from the global day rollups or the user's totals row.
+        """
+        if user_id is None:
+            df = self._frame("day", False)
+        else:
+            with self._lock:
+                if self.user_totals is None or user_id not in self.user_totals.index:
+                    return pd.Series({c: 0 for c in AGG})
+                return self.user_totals.loc[user_id, list(AGG)].copy()
+        if df is None or df.empty:
+            return pd.Series({c: 0 for c in AGG})
+        totals = df[COUNT_COLS].sum()
+        totals["risk_max"] = df["risk_max"].max()
+        return totals
+
+    def unique_users(self) -> int:
+        with self._lock:
+            return 0 if self.user_totals is None else len(self.user_totals)
+
+
+def _retention(resolution: str, by_user: bool):
+    return (USER_ROLLUP_RETENTION if by_user else ROLLUP_RETENTION)[resolution]
+
+
+def _partitions(rollup: pd.DataFrame, resolution: str):
+    """
+    (partition, rows) pairs of a rollup table, see PARTITIONS.
+    """
+    if rollup.empty:
+        return []
+    first = rollup["bucket"].min().strftime(PARTITIONS[resolution])
+    if rollup["bucket"].max().strftime(PARTITIONS[resolution]) == first:
+        # A flush almost always falls in one partition.
+        return [(first, rollup)]
+    parts = rollup["bucket"].dt.strftime(PARTITIONS[resolution])
+    return [(part, rows.reset_index(drop=True)) for part, rows in rollup.groupby(parts)]
+
+
+def _user_totals(rollup: pd.DataFrame) -> pd.DataFrame:
+    """
+    One row per user, indexed by user_id, with their counters summed over
+    the buckets of `rollup`.
+    """
+    if rollup.empty:
+        return pd.DataFrame(columns=list(AGG), index=pd.Index([], name="user_id"))
+    return _aggregate(rollup, ["user_id"])
+
+
+def _user_partitions(totals: pd.DataFrame) -> set:
+    """
+    Names of the user totals partitions holding the users of `totals`.
+    """
+    ids = np.unique(totals.index.to_numpy().astype(int) % USER_TOTAL_PARTITIONS)
+    return {f"{i:02d}" for i in ids}
+
+
+def compact_history(history_df: pd.DataFrame, retention_days: int, now=None):
+    """
+    Split off raw events older than `retention_days`. Callers must make sure
+    the dropped events are already folded into the rollups (they are on every
+    append and on bootstrap) and into whatever else is derived from them
+    (scoring_state.compact_history_file does that for the scoring state).
+    Returns (kept_df, dropped_df).
+    """
+    if history_df.empty:
+        return history_df, history_df
+    now = pd.Timestamp(now) if now is not None else pd.Timestamp.now()
+    ts = pd.to_datetime(history_df["timestamp"], errors="coerce")
+    keep = ~(ts < now - pd.Timedelta(days=retention_days))
+    if keep.all():
+        return history_df, history_df.iloc[:0]
+    return history_df[keep].reset_index(drop=True), history_df[~keep].reset_index(drop=True)
@@ -0,0 +1,519 @@
+import json
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from peer_baselines import own_weight
+from scoring_state import UserProfiles, drop_compacted, export_compacted, import_compacted
+
+
+MODEL_WEIGHT = 0.6
+BEHAVIOR_WEIGHT = 0.4
+LOW_RISK_MAX = 30
+MEDIUM_RISK_MAX = 60
+
+HISTORY_COLS = [
+    "timestamp", "user_id", "country", "device", "action", "action_model", "hour",
+    "VPN", "failed_logins", "typing_speed",
+    "model_risk", "behavior_risk", "final_risk",
+    "level", "decision", "risk_contributions",
+]
+
+
+COUNTRY_OPTIONS = [
+    
+    "Saudi Arabia (KSA)",
+    "United Arab Emirates",
+    "Qatar",
+    "Bahrain",
+    "Kuwait",
+    "Oman",
+    
+    "Jordan",
+    "Egypt",
+    "Morocco",
+    "Algeria",
+    "Tunisia",
+    "Lebanon",
+    "Iraq",
+    "Syria",
+    "Palestine",
+    "Yemen",
+    "Sudan",
+    
+    "United States",
+    "United Kingdom",
+    "Canada",
+    "Germany",
+    "France",
+    "Spain",
+    "Italy",
+    "Netherlands",
+    "Switzerland",
+    "India",
+    "Pakistan",
+    "Philippines",
+    "China",
+    "Japan",
+    "South Korea",
+    "Brazil",
+    "South Africa",
+    
+    "Other",
+]
+
+
+HIGH_RISK_COUNTRIES = {
+    "Iraq",
+    "Syria",
+    "Yemen",
+    "Sudan",
+    "Brazil",        
+    "South Africa",  
+}
+
+def map_country_to_model(country_ui: str) -> str:
+    """
+    Map the UI country selection to 3 coarse categories: KSA, Unknown,
+    HighRiskCountry. The model itself is trained on the full country list.
+    """
+    if country_ui in ["Saudi Arabia (KSA)", "KSA"]:
+        return "KSA"
+    if country_ui in HIGH_RISK_COUNTRIES:
+        return "HighRiskCountry"
+    return "Unknown"
+
+
+
+ACTION_OPTIONS = [
+    
+    "view_profile",
+    "view_services",
+    "view_violations",
+    "view_vehicle_list",
+    "view_passport_details",
+
+    
+    "update_mobile",
+    "update_email",
+    "update_address",
+    "renew_id",
+    "replace_lost_id",
+    "digital_id_access",
+
+    "renew_passport",
+    "issue_passport",
+    "replace_lost_passport",
+
+    "renew_driver_license",
+    "replace_lost_license",
+    "pay_violation",
+
+    "vehicle_transfer",
+    "renew_vehicle_registration",
+    "insurance_verification",
+
+    "issue_worker_exit_reentry",
+    "cancel_exit_reentry",
+    "update_sponsor",
+    "renew_worker_iqama",
+
+    "issue_birth_certificate",
+    "add_newborn",
+    "book_civil_appointment",
+
+    "book_appointment",
+    "cancel_appointment",
+    "reschedule_appointment",
+
+    "pay_fees",
+    "pay_ticket",
+    "pay_gov_services",
+
+    "report_cybercrime",
+    "emergency_alert",
+    "travel_permission_status",
+]
+
+def map_action_to_model(action_ui: str) -> str:
+    """
+    Map the UI action selection to 4 coarse categories used by the behavior
+    baselines (action_model in the history): view, pay, renew_passport,
+    update_mobile. The model itself is trained on the full action list.
+    """
+    if action_ui.startswith("view_"):
+        return "view"
+
+    if action_ui.startswith("pay_") or action_ui in ["pay_gov_services"]:
+        return "pay"
+
+    if "passport" in action_ui and "renew" in action_ui:
+        return "renew_passport"
+
+    if action_ui in [
+        "update_mobile",
+        "update_email",
+        "update_address",
+        "digital_id_access",
+    ]:
+        return "update_mobile"
+
+    
+    return "view"
+
+
+def features_from_event(event):
+    """
+    Rebuild the model input row of a stored history event.
+    """
+    return {
+        "user_id": int(event["user_id"]),
+        "time_of_day": int(event["hour"]),
+        "country": event["country"],
+        "device_type": event["device"],
+        "failed_logins_last_hour": int(event["failed_logins"]),
+        "action_type": event["action"],
+        "is_vpn": 1 if event["VPN"] == "Yes" else 0,
+        "typing_speed": float(event["typing_speed"]),
+    }
+
+
+def user_baseline(user_hist):
+    """
+    Reduce a user's history to the values the deviation checks compare against.
+    """
+    action_col = "action_model" if "action_model" in user_hist.columns else "action"
+    return {
+        "country": user_hist["country"].mode()[0],
+        "device": user_hist["device"].mode()[0],
+        "action": user_hist[action_col].mode()[0],
+        "hour": user_hist["hour"].mean(),
+        "typing_speed": user_hist["typing_speed"].mean(),
+        "failed_logins": user_hist["failed_logins"].mean(),
+    }
+
+
+def baseline_deviation(baseline, attempt_row, who="user"):
+    """
+    Returns (diffs, checks, reasons) comparing attempt_row to a baseline dict.
+    """
+    reasons = []
+    diffs = 0
+    checks = 0
+
+    checks += 1
+    common_country = baseline["country"]
+    if attempt_row["country"].iloc[0] != common_country:
+        diffs += 1
+        reasons.append(
+            f"Unusual country: {who} usually logs in from {common_country}, "
+            f"now from {attempt_row['country'].iloc[0]}."
+        )
+
+    checks += 1
+    common_device = baseline["device"]
+    if attempt_row["device"].iloc[0] != common_device:
+        diffs += 1
+        reasons.append(
+            f"Unusual device: typical device is {common_device}, "
+            f"now using {attempt_row['device'].iloc[0]}."
+        )
+
+    checks += 1
+    common_action = baseline["action"]
+    current_action = attempt_row["action"].iloc[0]
+    if current_action != common_action:
+        diffs += 1
+        reasons.append(
+            f"Unusual action: usual action is {common_action}, "
+            f"now requesting {current_action}."
+        )
+
+    checks += 1
+    avg_hour = baseline["hour"]
+    hour_now = attempt_row["hour"].iloc[0]
+    if abs(hour_now - avg_hour) > 5:
+        diffs += 1
+        reasons.append(
+            f"Unusual time: average login around {avg_hour:.1f}h, now at {hour_now}h."
+        )
+
+    checks += 1
+    avg_speed = baseline["typing_speed"]
+    speed_now = attempt_row["typing_speed"].iloc[0]
+    if abs(speed_now - avg_speed) > 2:
+        diffs += 1
+        reasons.append(
+            f"Typing pattern changed: normal speed ~{avg_speed:.1f} chars/sec, now {speed_now:.1f}."
+        )
+
+    checks += 1
+    avg_fail = baseline["failed_logins"]
+    fails_now = attempt_row["failed_logins"].iloc[0]
+    if fails_now >= avg_fail + 2:
+        diffs += 1
+        reasons.append(
+            f"More failed logins than usual: average {avg_fail:.1f}, now {fails_now}."
+        )
+
+    return diffs, checks, reasons
+
+
+def peer_group_risk(peers, group, distance, attempt_row):
+    """
+    Returns (risk 0-100, reasons) for attempt_row against one peer group's
+    baseline, plus one check for being outside the group's radius.
+    """
+    diffs, checks, reasons = baseline_deviation(peers.baselines[group], attempt_row, who="this peer group")
+    checks += 1
+    if distance > peers.radius[group]:
+        diffs += 1
+        reasons.append("Behavior does not fit this peer group.")
+    return diffs / max(checks, 1) * 100, reasons
+
+
+def first_login_peer_risk(peers, attempt_row):
+    """
+    Returns (risk 0-100, reasons) for a user without history. The attempt
+    must not choose the group it is compared with (a suspicious attempt
+    always resembles some group most), so it is scored against every group,
+    weighted by the group's share of users. Reasons are those against the
+    largest group.
+    """
+    shares = peers.shares()
+    dists = peers.distances(peers.event_vectors(attempt_row)[0])
+    risks, group_reasons = zip(*(peer_group_risk(peers, g, dists[g], attempt_row) for g in range(len(shares))))
+    reasons = list(group_reasons[int(shares.argmax())])
+    if (dists > peers.radius).all():
+        reasons.append("Behavior does not fit any known peer group.")
+    return float(np.dot(shares, risks)), reasons
+
+
+def compute_behavior_deviation(user_id, attempt_row, full_history, peers=None, profiles=None):
+    """
+    Returns (behavior_risk_score 0-100, reasons list) based on this user's history.
+    History uses the same columns as attempt_row: country, device, action, hour, VPN, failed_logins, typing_speed
+
+    With peer baselines, sparse-history users are also scored against the
+    peer group nearest to their history, blended toward their own profile
+    as their history grows. First-time users are scored against all peer
+    groups, weighted by size.
+
+    With `profiles` (scoring_state.UserProfiles) the user's baseline comes
+    from the running per-user statistics and `full_history` is not used.
+    """
+    if profiles is not None:
+        n_events = profiles.count(user_id)
+    else:
+        user_hist = full_history[full_history["user_id"] == user_id]
+        n_events = len(user_hist)
+
+    if n_events == 0 and peers is None:
+        return 0, ["First login or limited history – baseline is being established for this user."]
+
+    reasons = []
+    own_risk = 0
+    if n_events:
+        baseline = profiles.baseline(user_id) if profiles is not None else user_baseline(user_hist)
+        diffs, checks, reasons = baseline_deviation(baseline, attempt_row)
+        own_risk = diffs / max(checks, 1) * 100
+
+    w = own_weight(n_events) if peers is not None else 1.0
+    peer_risk = 0
+    if w < 1.0:
+        if n_events == 0:
+            peer_risk, peer_reasons = first_login_peer_risk(peers, attempt_row)
+            reasons.append("First login – scored against all peer groups, weighted by their size.")
+        else:
+            if profiles is not None:
+                group, distance = peers.nearest_vector(profiles.peer_vector(user_id, peers))
+            else:
+                group, distance = peers.nearest(user_hist)
+            peer_risk, peer_reasons = peer_group_risk(peers, group, distance, attempt_row)
+            reasons.append(f"Limited history ({n_events} events) – blended with peer group baseline.")
+        reasons += [f"Peer group: {r}" for r in peer_reasons]
+
+    behavior_risk = int(w * own_risk + (1 - w) * peer_risk)
+
+    if behavior_risk == 0:
+        if n_events:
+            reasons.append("Behavior closely matches user’s historical pattern.")
+        else:
+            reasons.append("Behavior matches the typical peer-group pattern.")
+
+    return behavior_risk, reasons
+
+
+def risk_level(final_risk):
+    """
+    Returns (level, decision) for a final risk score.
+    """
+    if final_risk < LOW_RISK_MAX:
+        return "LOW", "Allow"
+    if final_risk < MEDIUM_RISK_MAX:
+        return "MEDIUM", "Challenge"
+    return "HIGH", "Block"
+
+
+def score_attempt(model, history, user_id, country_ui, device_type, action_ui, time_of_day,
+                  failed_logins_last_hour, is_vpn, typing_speed, peers=None, attribution=None,
+                  profiles=None):
+    """
+    Score one login attempt. `history` only needs this user's past events
+    and may be None when `profiles` is given.
+    Returns (record, behavior_reasons) where record is the history row to
+    store, including the model risk contributions for HIGH/MEDIUM levels
+    when an attribution is given.
+    """
+    country_model = map_country_to_model(country_ui)
+    action_model = map_action_to_model(action_ui)
+
+    features_row = pd.DataFrame([{
+        "user_id": user_id,
+        "time_of_day": time_of_day,
+        "country": country_ui,
+        "device_type": device_type,
+        "failed_logins_last_hour": failed_logins_last_hour,
+        "action_type": action_ui,
+        "is_vpn": is_vpn,
+        "typing_speed": typing_speed
+    }])
+
+    prob_attack = model.predict_proba(features_row)[0][1]
+    model_risk = int(prob_attack * 100)
+
+    attempt_for_behavior = pd.DataFrame([{
+        "user_id": user_id,
+        "country": country_ui,
+        "country_model": country_model,
+        "device": device_type,
+        "action": action_model,
+        "hour": time_of_day,
+        "VPN": "Yes" if is_vpn == 1 else "No",
+        "failed_logins": failed_logins_last_hour,
+        "typing_speed": typing_speed
+    }])
+
+    behavior_risk, behavior_reasons = compute_behavior_deviation(
+        user_id, attempt_for_behavior, history, peers=peers, profiles=profiles
+    )
+
+    final_risk = min(100, int(MODEL_WEIGHT * model_risk + BEHAVIOR_WEIGHT * behavior_risk))
+    level, decision = risk_level(final_risk)
+
+    risk_contributions = None
+    if attribution is not None and level in ("HIGH", "MEDIUM"):
+        risk_contributions = attribution.explain_records(features_row)[0]
+
+    record = {
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "user_id": user_id,
+        "country": country_ui,
+        "device": device_type,
+        "action": action_ui,
+        "action_model": action_model,
+        "hour": time_of_day,
+        "VPN": "Yes" if is_vpn == 1 else "No",
+        "failed_logins": failed_logins_last_hour,
+        "typing_speed": typing_speed,
+        "model_risk": model_risk,
+        "behavior_risk": behavior_risk,
+        "final_risk": final_risk,
+        "level": level,
+        "decision": decision,
+        "risk_contributions": json.dumps(risk_contributions) if risk_contributions else "",
+    }
+    return record, behavior_reasons
+
+
+class Scorer:
+    """
+    Stand-alone scoring state outside Streamlit: the model plus running
+    per-user statistics (scoring_state.UserProfiles), so memory and the
+    per-request cost stay bounded however long a user's history grows.
+    Used by scoring_server.py and the in-process load test.
+    """
+
+    def __init__(self, model, history=None, peers=None, attribution=None, writer=None, alerts=None,
+                 profiles=None):
+        self.model = model
+        self.peers = peers
+        self.attribution = attribution
+        self.writer = writer
+        self.alerts = alerts
+        self.profiles = profiles if profiles is not None else UserProfiles()
+        if history is not None and not history.empty:
+            self.profiles.add_events(history)
+
+    def score(self, request: dict) -> dict:
+        """
+        request: user_id, country, device, action, hour, failed_logins, vpn,
+        typing_speed (country/action use the UI vocabularies).
+        Returns the stored record plus its behavior reasons.
+        """
+        user_id = int(request["user_id"])
+        record, reasons = score_attempt(
+            self.model, None, user_id,
+            request["country"], request["device"], request["action"],
+            int(request["hour"]), int(request["failed_logins"]), int(request["vpn"]),
+            float(request["typing_speed"]),
+            peers=self.peers, attribution=self.attribution, profiles=self.profiles,
+        )
+
+        self.profiles.add_record(record)
+        if self.writer is not None:
+            self.writer.submit(record)
+        if self.alerts is not None:
+            self.alerts.submit(record)
+        return {**record, "reasons": reasons}
+
+    def user_ids(self) -> list:
+        return self.profiles.user_ids()
+
+    def export_users(self, user_ids) -> dict:
+        """
+        The statistics of `user_ids` plus their rows and compacted profiles
+        in the history segment (when persisting), for handing the users to
+        another shard. The users stay here until drop_users().
+        """
+        exported = {"profiles": self.profiles.export(user_ids), "events": []}
+        if self.writer is not None:
+            exported["events"] = self.writer.read_users(user_ids)
+            exported["compacted"] = export_compacted(self.writer.path, user_ids)
+        return exported
+
+    def import_users(self, exported: dict) -> int:
+        """
+        Take over users exported by another shard. Their rows and compacted
+        profiles replace any of theirs already in this scorer's history
+        segment (e.g. from an earlier, failed hand-over), so importing the
+        same export twice leaves the same state as importing it once.
+        """
+        imported = self.profiles.merge(exported["profiles"])
+        events = exported.get("events", [])
+        if self.writer is not None:
+            ids = set(exported["profiles"]["user_ids"]) | {int(e["user_id"]) for e in events}
+            if ids:
+                self.writer.remove_users(ids)
+            if "compacted" in exported:
+                import_compacted(self.writer.path, ids, exported["compacted"])
+            # Flush as we go so a large hand-over never overflows the queue.
+            for i, event in enumerate(events, 1):
+                self.writer.submit(event)
+                if i % self.writer.batch_size == 0:
+                    self.writer.flush()
+            self.writer.flush()
+        return imported
+
+    def drop_users(self, user_ids) -> int:
+        """
+        Forget `user_ids` once another shard owns them, including their rows
+        and compacted profiles in the history segment.
+        """
+        ids = {int(u) for u in user_ids}
+        dropped = self.profiles.drop(ids)
+        if self.writer is not None and ids:
+            self.writer.remove_users(ids)
+            drop_compacted(self.writer.path, ids)
+        return dropped
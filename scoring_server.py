@@ -0,0 +1,185 @@
+import argparse
+import http.client
+import json
+import os
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+from alerts import AlertDispatcher, FileSink
+from attribution import ForestAttribution
+from history_writer import HistoryWriter
+from mapped_model import MAPPED_MODEL_DIR, load_model
+from peer_baselines import PeerBaselines
+from rollups import compact_history
+from scoring import HISTORY_COLS, Scorer
+from scoring_state import compact_history_file, load_compacted
+
+
+MODEL_FILE = "gart_model.pkl"
+HISTORY_FILE = "gart_user_history.csv"
+PEER_BASELINES_FILE = "gart_peer_baselines.pkl"
+# Same policy as the app: raw rows older than the retention are compacted on
+# start, once the oldest is COMPACT_SLACK_DAYS past it.
+RAW_RETENTION_DAYS = 30
+COMPACT_SLACK_DAYS = 1
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    """
+    POST /score with a JSON attempt returns the scored record as JSON.
+    GET /health returns the number of users held by this scorer.
+
+    Shard hand-over (used by sharding.ShardRouter):
+    GET /users lists the user ids held here,
+    POST /export_users {"user_ids": [...]} returns their statistics and rows,
+    POST /import_users with that export takes the users over,
+    POST /drop_users {"user_ids": [...]} forgets them.
+    """
+
+    protocol_version = "HTTP/1.1"
+    scorer = None
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length))
+
+    def do_POST(self):
+        routes = {
+            "/score": lambda body: self.scorer.score(body),
+            "/export_users": lambda body: self.scorer.export_users(body["user_ids"]),
+            "/import_users": lambda body: {"imported": self.scorer.import_users(body)},
+            "/drop_users": lambda body: {"dropped": self.scorer.drop_users(body["user_ids"])},
+        }
+        if self.path not in routes:
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            result = routes[self.path](self._read_json())
+        except (KeyError, ValueError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, result)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok", "users": len(self.scorer.user_ids())})
+        elif self.path == "/users":
+            self._send_json(200, {"user_ids": self.scorer.user_ids()})
+        else:
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ScoringClient:
+    """
+    Calls a scoring_server.py instance (or the shard router), one
+    keep-alive connection per thread.
+    """
+
+    def __init__(self, url: str, timeout: float = 30):
+        parsed = urllib.parse.urlparse(url)
+        self.url = url
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.prefix = parsed.path.rstrip("/")
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def call(self, method: str, path: str, payload=None) -> dict:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        body = None if payload is None else json.dumps(payload, default=str)
+        try:
+            conn.request(method, self.prefix + path, body, {"Content-Type": "application/json"})
+            response = conn.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            self._local.conn = None
+            raise
+        if response.status != 200:
+            raise RuntimeError(f"{self.url}{path} returned {response.status}: {data[:200]!r}")
+        return json.loads(data)
+
+    def score(self, request: dict) -> dict:
+        return self.call("POST", "/score", request)
+
+
+def make_server(scorer: Scorer, host: str = "127.0.0.1", port: int = 8502) -> ThreadingHTTPServer:
+    handler = type("BoundScoringHandler", (ScoringHandler,), {"scorer": scorer})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def load_scorer(model_file: str = MODEL_FILE, history_file: str = HISTORY_FILE,
+                peers_file: str = PEER_BASELINES_FILE, persist: bool = False,
+                mapped_dir: str = MAPPED_MODEL_DIR, alert_file: str = None,
+                retention_days: int = RAW_RETENTION_DAYS) -> Scorer:
+    """
+    Build a Scorer from the files the app uses. The memory-mapped model is
+    used when it is up to date, so scorer processes on a host share it.
+    With `alert_file`, Block / Challenge alerts are appended there. With persist=True new records
+    are appended to `history_file` through a background HistoryWriter, and
+    rows older than `retention_days` are first compacted out of it. User
+    statistics start from the rows compacted out of `history_file`, if any.
+    """
+    model = load_model(model_file, mapped_dir)
+    history = pd.read_csv(history_file) if os.path.exists(history_file) else None
+    if persist and history is not None and not compact_history(history, retention_days + COMPACT_SLACK_DAYS)[1].empty:
+        compact_history_file(history_file, retention_days)
+        history = pd.read_csv(history_file)
+    profiles = load_compacted(history_file).profiles
+    peers = PeerBaselines.load(peers_file) if os.path.exists(peers_file) else None
+    writer = None
+    if persist:
+        writer = HistoryWriter(history_file, HISTORY_COLS).start()
+    alerts = AlertDispatcher([FileSink(alert_file)]).start() if alert_file else None
+    return Scorer(model, history, peers=peers, attribution=ForestAttribution(model), writer=writer, alerts=alerts,
+                  profiles=profiles)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve GART risk scoring over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8502)
+    parser.add_argument("--model", default=MODEL_FILE)
+    parser.add_argument("--history", default=HISTORY_FILE)
+    parser.add_argument("--peers", default=PEER_BASELINES_FILE)
+    parser.add_argument("--persist", action="store_true", help="append scored events to the history file")
+    parser.add_argument("--alert-file", help="append Block / Challenge alerts to this JSON-lines file")
+    parser.add_argument("--retention-days", type=int, default=RAW_RETENTION_DAYS,
+                        help="with --persist, compact history rows older than this on start")
+    args = parser.parse_args()
+
+    scorer = load_scorer(args.model, args.history, args.peers, persist=args.persist, alert_file=args.alert_file,
+                         retention_days=args.retention_days)
+    server = make_server(scorer, args.host, args.port)
+    print(f"Scoring on http://{args.host}:{args.port}/score")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if scorer.writer is not None:
+            scorer.writer.stop()
+        if scorer.alerts is not None:
+            scorer.alerts.stop()
@@ -0,0 +1,736 @@
+"""
+Derived scoring state that the app would otherwise rebuild from the whole
+history on every start: per-user baselines, dashboard counters and the
+recent-event buffers.
+
+The state is checkpointed to a joblib snapshot together with the
+byte offset of the history CSV it covers. On start the snapshot is loaded
+and only the rows appended after that offset are replayed. The full history
+is read only if there is no usable snapshot, e.g. after the file was
+rewritten by something other than compact_history_file.
+
+Rows removed from the history by compaction are folded into a second state
+file next to it (compacted_file), so baselines, counters and recent events
+still cover them when the state is rebuilt from the raw rows.
+
+    python scoring_state.py bench --sizes 10000 100000 1000000 --tail 1000
+"""
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from recent_events import RECENT_CAPACITY, RECENT_PER_USER, RECENT_USERS, RecentEvents
+from rollups import RISK_VALUES, compact_history, risk_pair_histogram
+
+
+logger = logging.getLogger(__name__)
+
+HISTORY_FILE = "gart_user_history.csv"
+STATE_SNAPSHOT_FILE = "gart_state_snapshot.pkl"
+SNAPSHOT_VERSION = 1
+
+# Bytes before the snapshot offset kept to check the file was only appended to.
+FINGERPRINT_BYTES = 256
+
+NUMERIC = ["hour", "typing_speed", "failed_logins"]
+CATEGORICAL = ["country", "device", "action"]
+
+
+class UserProfiles:
+    """
+    Running per-user statistics from which scoring.user_baseline's values
+    (most common country / device / action, mean hour / typing speed /
+    failed logins) and the peer-group profile vector are derived, without
+    keeping the user's rows. Counts and sums live in arrays, one row per user;
+    the arrays grow by doubling, so adding users one at a time stays cheap.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {}
+        self.n = np.zeros(0, dtype=np.int64)
+        self.sums = np.zeros((0, len(NUMERIC)))
+        self.counts = np.zeros((0, len(NUMERIC)), dtype=np.int64)
+        self.hour_circle = np.zeros((0, 2))
+        self.vocab = {field: [] for field in CATEGORICAL}
+        self.value_counts = {field: np.zeros((0, 0), dtype=np.int64) for field in CATEGORICAL}
+        self._codes = {field: {} for field in CATEGORICAL}
+
+    def _rows(self, user_ids: np.ndarray) -> np.ndarray:
+        new = [u for u in pd.unique(user_ids) if u not in self.users]
+        if new:
+            start = len(self.users)
+            self.users.update({int(u): start + i for i, u in enumerate(new)})
+            if len(self.users) > len(self.n):
+                self._grow(max(len(self.users), 2 * len(self.n), 64) - len(self.n))
+        return np.array([self.users[int(u)] for u in user_ids], dtype=np.int64)
+
+    def _grow(self, k: int):
+        self.n = np.concatenate([self.n, np.zeros(k, dtype=np.int64)])
+        self.sums = np.vstack([self.sums, np.zeros((k, len(NUMERIC)))])
+        self.counts = np.vstack([self.counts, np.zeros((k, len(NUMERIC)), dtype=np.int64)])
+        self.hour_circle = np.vstack([self.hour_circle, np.zeros((k, 2))])
+        for field in CATEGORICAL:
+            matrix = self.value_counts[field]
+            self.value_counts[field] = np.vstack([matrix, np.zeros((k, matrix.shape[1]), dtype=np.int64)])
+
+    def _value_codes(self, field: str, values: pd.Series) -> np.ndarray:
+        codes = self._codes[field]
+        new = [v for v in pd.unique(values) if v not in codes]
+        if new:
+            for v in new:
+                codes[v] = len(self.vocab[field])
+                self.vocab[field].append(v)
+            matrix = self.value_counts[field]
+            self.value_counts[field] = np.hstack([matrix, np.zeros((matrix.shape[0], len(new)), dtype=np.int64)])
+        return values.map(codes).to_numpy(dtype=np.int64)
+
+    def add_events(self, events: pd.DataFrame):
+        if events.empty:
+            return
+        with self.lock:
+            rows = self._rows(events["user_id"].astype(int).to_numpy())
+            np.add.at(self.n, rows, 1)
+
+            for j, col in enumerate(NUMERIC):
+                values = pd.to_numeric(events[col], errors="coerce").to_numpy(dtype=float)
+                ok = ~np.isnan(values)
+                np.add.at(self.sums[:, j], rows[ok], values[ok])
+                np.add.at(self.counts[:, j], rows[ok], 1)
+                if col == "hour":
+                    angle = 2 * np.pi * values[ok] / 24
+                    np.add.at(self.hour_circle[:, 0], rows[ok], np.sin(angle))
+                    np.add.at(self.hour_circle[:, 1], rows[ok], np.cos(angle))
+
+            for field in CATEGORICAL:
+                # Same column choice as scoring.user_baseline.
+                col = "action_model" if field == "action" and "action_model" in events.columns else field
+                ok = events[col].notna().to_numpy()
+                codes = self._value_codes(field, events[col][ok])
+                np.add.at(self.value_counts[field], (rows[ok], codes), 1)
+
+    def add_record(self, record: dict):
+        """
+        add_events for a single history record, without building a frame.
+        """
+        with self.lock:
+            uid = int(record["user_id"])
+            row = self.users.get(uid)
+            if row is None:
+                row = self._rows(np.array([uid]))[0]
+            self.n[row] += 1
+
+            for j, col in enumerate(NUMERIC):
+                try:
+                    value = float(record.get(col))
+                except (TypeError, ValueError):
+                    continue
+                if np.isnan(value):
+                    continue
+                self.sums[row, j] += value
+                self.counts[row, j] += 1
+                if col == "hour":
+                    angle = 2 * np.pi * value / 24
+                    self.hour_circle[row] += (np.sin(angle), np.cos(angle))
+
+            for field in CATEGORICAL:
+                col = "action_model" if field == "action" and "action_model" in record else field
+                value = record.get(col)
+                if pd.isna(value):
+                    continue
+                code = self._codes[field].get(value)
+                if code is None:
+                    code = self._value_codes(field, pd.Series([value], dtype=object))[0]
+                self.value_counts[field][row, code] += 1
+
+    def count(self, user_id) -> int:
+        with self.lock:
+            row = self.users.get(int(user_id))
+            return 0 if row is None else int(self.n[row])
+
+    def baseline(self, user_id) -> dict:
+        """
+        The dict scoring.user_baseline would return for this user's rows.
+        Ties for the most common value resolve to the smallest value, as
+        with Series.mode()[0].
+        """
+        with self.lock:
+            return self._baseline([self.users[int(user_id)]])
+
+    def group_baseline(self, user_ids) -> dict:
+        """
+        The same for all events of `user_ids` taken together, e.g. a peer group.
+        """
+        with self.lock:
+            return self._baseline([self.users[int(u)] for u in user_ids])
+
+    def _baseline(self, rows) -> dict:
+        out = {}
+        for field in CATEGORICAL:
+            counts = self.value_counts[field][rows].sum(axis=0)
+            top = np.flatnonzero(counts == counts.max()) if counts.any() else []
+            out[field] = min(self.vocab[field][i] for i in top) if len(top) else None
+        sums = self.sums[rows].sum(axis=0)
+        counts = self.counts[rows].sum(axis=0)
+        for j, col in enumerate(NUMERIC):
+            out[col] = sums[j] / counts[j] if counts[j] else np.nan
+        return out
+
+    def peer_vector(self, user_id, peers) -> np.ndarray:
+        """
+        Mean of peers.event_vectors() over this user's events.
+        """
+        with self.lock:
+            row = self.users[int(user_id)]
+            n = self.n[row]
+            parts = []
+            for field, vocab in (("country", peers.countries), ("device", peers.devices), ("action", peers.actions)):
+                codes = self._codes[field]
+                counts = self.value_counts[field][row]
+                parts.append(np.array([counts[codes[v]] if v in codes else 0 for v in vocab]) / n)
+            speed = self.sums[row, NUMERIC.index("typing_speed")] / n / 10
+            return np.concatenate(parts + [self.hour_circle[row] / n, [speed]])
+
+    def peer_vectors(self, peers):
+        """
+        peer_vector for every user at once. Returns (user_ids, event counts,
+        vectors).
+        """
+        with self.lock:
+            size = len(self.users)
+            user_ids = np.empty(size, dtype=np.int64)
+            for uid, row in self.users.items():
+                user_ids[row] = uid
+            n = self.n[:size].astype(float)
+            parts = []
+            for field, vocab in (("country", peers.countries), ("device", peers.devices), ("action", peers.actions)):
+                codes = self._codes[field]
+                counts = self.value_counts[field][:size]
+                share = np.zeros((size, len(vocab)))
+                for j, v in enumerate(vocab):
+                    if v in codes:
+                        share[:, j] = counts[:, codes[v]] / n
+                parts.append(share)
+            hour = self.hour_circle[:size] / n[:, None]
+            speed = self.sums[:size, NUMERIC.index("typing_speed")] / n / 10
+            return user_ids, self.n[:size].copy(), np.hstack(parts + [hour, speed[:, None]])
+
+    def user_ids(self) -> list:
+        with self.lock:
+            return list(self.users)
+
+    def export(self, user_ids) -> dict:
+        """
+        The statistics of `user_ids` as plain lists (JSON-safe), for handing
+        the users to another scorer with merge().
+        """
+        with self.lock:
+            ids = [int(u) for u in dict.fromkeys(user_ids) if int(u) in self.users]
+            rows = [self.users[u] for u in ids]
+            out = {
+                "user_ids": ids,
+                "n": self.n[rows].tolist(),
+                "sums": self.sums[rows].tolist(),
+                "counts": self.counts[rows].tolist(),
+                "hour_circle": self.hour_circle[rows].tolist(),
+                "value_counts": {},
+            }
+            for field in CATEGORICAL:
+                matrix = self.value_counts[field][rows]
+                used = np.flatnonzero(matrix.sum(axis=0))
+                out["value_counts"][field] = {
+                    "values": [self.vocab[field][i] for i in used],
+                    "counts": matrix[:, used].tolist(),
+                }
+            return out
+
+    def merge(self, exported: dict) -> int:
+        """
+        Take over users from another UserProfiles' export(). A user already
+        held here is replaced, not added to.
+        """
+        with self.lock:
+            ids = np.array(exported["user_ids"], dtype=np.int64)
+            if not len(ids):
+                return 0
+            rows = self._rows(ids)
+            self.n[rows] = exported["n"]
+            self.sums[rows] = exported["sums"]
+            self.counts[rows] = exported["counts"]
+            self.hour_circle[rows] = exported["hour_circle"]
+            for field in CATEGORICAL:
+                part = exported["value_counts"][field]
+                codes = self._value_codes(field, pd.Series(part["values"], dtype=object))
+                self.value_counts[field][rows] = 0
+                self.value_counts[field][np.ix_(rows, codes)] = np.array(part["counts"], dtype=np.int64).reshape(
+                    len(rows), len(codes))
+            return len(ids)
+
+    def drop(self, user_ids) -> int:
+        """
+        Forget `user_ids`. Returns how many were held here.
+        """
+        with self.lock:
+            ids = {int(u) for u in user_ids} & self.users.keys()
+            if not ids:
+                return 0
+            keep_ids = [u for u in sorted(self.users, key=self.users.get) if u not in ids]
+            keep = np.array([self.users[u] for u in keep_ids], dtype=np.int64)
+            self.users = {u: i for i, u in enumerate(keep_ids)}
+            self.n = self.n[keep]
+            self.sums = self.sums[keep]
+            self.counts = self.counts[keep]
+            self.hour_circle = self.hour_circle[keep]
+            self.value_counts = {f: m[keep] for f, m in self.value_counts.items()}
+            return len(ids)
+
+    def to_arrays(self) -> dict:
+        with self.lock:
+            size = len(self.users)
+            user_ids = np.empty(size, dtype=np.int64)
+            for uid, row in self.users.items():
+                user_ids[row] = uid
+            return {
+                "user_ids": user_ids,
+                "n": self.n[:size].copy(),
+                "sums": self.sums[:size].copy(),
+                "counts": self.counts[:size].copy(),
+                "hour_circle": self.hour_circle[:size].copy(),
+                "vocab": {f: list(v) for f, v in self.vocab.items()},
+                "value_counts": {f: m[:size].copy() for f, m in self.value_counts.items()},
+            }
+
+    @classmethod
+    def from_arrays(cls, arrays: dict) -> "UserProfiles":
+        profiles = cls()
+        profiles.users = {int(u): i for i, u in enumerate(arrays["user_ids"])}
+        profiles.n = arrays["n"]
+        profiles.sums = arrays["sums"]
+        profiles.counts = arrays["counts"]
+        profiles.hour_circle = arrays["hour_circle"]
+        profiles.vocab = arrays["vocab"]
+        profiles.value_counts = arrays["value_counts"]
+        profiles._codes = {f: {v: i for i, v in enumerate(vocab)} for f, vocab in profiles.vocab.items()}
+        return profiles
+
+
+class ScoringState:
+    """
+    Everything the app derives from the history: user profiles, country /
+    action counters, recent-event buffers, the (model_risk, behavior_risk)
+    histogram and time span used by replay.py, and the history position
+    (byte offset plus a fingerprint) they cover. `compacted_before` is the
+    compaction cutoff of the rows folded in from the raw file's past.
+    """
+
+    def __init__(self, capacity: int = RECENT_CAPACITY, per_user: int = RECENT_PER_USER,
+                 max_users: int = RECENT_USERS):
+        self.profiles = UserProfiles()
+        self.recent = RecentEvents(capacity, per_user, max_users)
+        self.country_counts = Counter()
+        self.action_counts = Counter()
+        self.events = 0
+        self.risk_pairs = np.zeros((RISK_VALUES, RISK_VALUES), dtype=np.int64)
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.position = None
+        self.compacted_before = None
+        self.lock = threading.Lock()
+        self._saved_at = time.monotonic()
+        self._unflushed = 0
+        # Set when a batch could not be folded in; see save().
+        self.stale = False
+
+    def append(self, record: dict):
+        """
+        Put a just-scored record into the recent-event buffers right away,
+        before the history writer has written it. The rest of the state
+        follows when the written batch arrives with add_events(recent=False).
+        """
+        with self.lock:
+            self.recent.append(record)
+            self._unflushed += 1
+
+    def add_events(self, events: pd.DataFrame, position: dict = None, recent: bool = True):
+        """
+        Fold history rows into the state. With recent=False they are
+        already in the recent-event buffers through append().
+        """
+        with self.lock:
+            try:
+                if not events.empty:
+                    self.profiles.add_events(events)
+                    if recent:
+                        self.recent.add_history(events)
+                    else:
+                        self._unflushed = max(self._unflushed - len(events), 0)
+                    self.country_counts.update(events["country"].value_counts().to_dict())
+                    self.action_counts.update(events["action"].value_counts().to_dict())
+                    self.events += len(events)
+                    self.risk_pairs += risk_pair_histogram(events)
+                    self._extend_span(events["timestamp"].dropna().astype(str))
+            except Exception:
+                self.stale = True
+                raise
+            if position is not None:
+                self.position = position
+
+    def _extend_span(self, ts: pd.Series):
+        # "%Y-%m-%d %H:%M:%S" strings sort chronologically.
+        if ts.empty:
+            return
+        first, last = ts.min(), ts.max()
+        self.first_timestamp = first if self.first_timestamp is None else min(self.first_timestamp, first)
+        self.last_timestamp = last if self.last_timestamp is None else max(self.last_timestamp, last)
+
+    def top_counts(self, field: str, n: int = 10) -> pd.Series:
+        counts = self.country_counts if field == "country" else self.action_counts
+        with self.lock:
+            return pd.Series(dict(counts.most_common(n)), dtype="int64")
+
+    def save(self, path: str = STATE_SNAPSHOT_FILE):
+        """
+        Write the snapshot. Skipped once a batch failed to fold in: the last
+        good snapshot then makes the next start replay that batch.
+        """
+        if self.stale:
+            logger.error("Scoring state missed a batch of events; not saving %s", path)
+            self._saved_at = time.monotonic()
+            return
+        with self.lock:
+            payload = {
+                "version": SNAPSHOT_VERSION,
+                "position": self.position,
+                "compacted_before": self.compacted_before,
+                "events": self.events,
+                "risk_pairs": self.risk_pairs.copy(),
+                "first_timestamp": self.first_timestamp,
+                "last_timestamp": self.last_timestamp,
+                "profiles": self.profiles.to_arrays(),
+                # Appended rows not yet in the file would be replayed again.
+                "recent": self.recent.to_snapshot(exclude_newest=self._unflushed),
+                "country_counts": dict(self.country_counts),
+                "action_counts": dict(self.action_counts),
+            }
+            self._saved_at = time.monotonic()
+        payload["recent"]["rows"] = _compact_frame(payload["recent"]["rows"])
+        tmp_path = path + ".tmp"
+        # Uncompressed: the arrays are written as they are, and saves run on
+        # the history writer's thread.
+        joblib.dump(payload, tmp_path)
+        os.replace(tmp_path, path)
+
+    def save_if_due(self, path: str, interval: float) -> bool:
+        if time.monotonic() - self._saved_at < interval:
+            return False
+        self.save(path)
+        return True
+
+    @classmethod
+    def load(cls, path: str = STATE_SNAPSHOT_FILE) -> "ScoringState":
+        payload = joblib.load(path)
+        if payload.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported snapshot version {payload.get('version')}")
+        state = cls()
+        state.profiles = UserProfiles.from_arrays(payload["profiles"])
+        state.recent = RecentEvents.from_snapshot(payload["recent"])
+        state.country_counts = Counter(payload["country_counts"])
+        state.action_counts = Counter(payload["action_counts"])
+        state.events = payload["events"]
+        if "risk_pairs" in payload:
+            state.risk_pairs = payload["risk_pairs"]
+        state.first_timestamp = payload.get("first_timestamp")
+        state.last_timestamp = payload.get("last_timestamp")
+        state.position = payload["position"]
+        state.compacted_before = payload.get("compacted_before")
+        return state
+
+
+def _compact_frame(frame: pd.DataFrame) -> pd.DataFrame:
+    # Low-cardinality text columns (country, level, ...) pickle far smaller
+    # and faster as categoricals.
+    for col in frame.columns:
+        if frame[col].dtype == object and frame[col].nunique() <= max(len(frame) // 100, 1):
+            frame[col] = frame[col].astype("category")
+    return frame
+
+
+def compacted_file(history_file: str = HISTORY_FILE) -> str:
+    """
+    State file holding the rows compacted out of `history_file`.
+    """
+    root, _ = os.path.splitext(history_file)
+    return f"{root}.compacted.pkl"
+
+
+def load_compacted(history_file: str = HISTORY_FILE, capacity: int = RECENT_CAPACITY,
+                   per_user: int = RECENT_PER_USER, max_users: int = RECENT_USERS) -> ScoringState:
+    """
+    State of the rows compacted out of `history_file`, or an empty state if
+    nothing was compacted yet. Its position is always None.
+    """
+    path = compacted_file(history_file)
+    if not os.path.exists(path):
+        return ScoringState(capacity, per_user, max_users)
+    state = ScoringState.load(path)
+    if state.recent.config() != (capacity, per_user, max_users):
+        rows = state.recent.frame()
+        state.recent = RecentEvents(capacity, per_user, max_users)
+        state.recent.add_history(rows, sort=False)
+    return state
+
+
+def compact_history_file(history_file: str, retention_days: int, now=None,
+                         capacity: int = RECENT_CAPACITY, per_user: int = RECENT_PER_USER,
+                         max_users: int = RECENT_USERS,
+                         state: "ScoringState" = None) -> int:
+    """
+    Remove raw rows older than `retention_days` from the history file after
+    folding them into its compacted state, so user baselines and counters
+    keep them. Rows an interrupted earlier run already folded in (older than
+    its cutoff) are not added twice. Returns the number of rows removed.
+
+    `state` is a live state that already covers the whole file (e.g. just
+    restored). Its contents stay valid, since compaction only moves rows
+    into the compacted state; only its position is moved to the rewritten
+    file, so it can be saved as the new snapshot without a rebuild.
+    """
+    now = pd.Timestamp(now) if now is not None else pd.Timestamp.now()
+    kept, dropped = compact_history(pd.read_csv(history_file), retention_days, now)
+    if dropped.empty:
+        return 0
+    removed = len(dropped)
+
+    archive = load_compacted(history_file, capacity, per_user, max_users)
+    if archive.compacted_before is not None:
+        ts = pd.to_datetime(dropped["timestamp"], errors="coerce")
+        dropped = dropped[~(ts < pd.Timestamp(archive.compacted_before))]
+    archive.add_events(dropped)
+    archive.compacted_before = str(now - pd.Timedelta(days=retention_days))
+    archive.save(compacted_file(history_file))
+
+    tmp_path = history_file + ".tmp"
+    kept.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, history_file)
+    if state is not None:
+        with state.lock:
+            state.position = history_position(history_file)
+    return removed
+
+
+def split_compacted(history_file: str, segments: dict, owner_of) -> dict:
+    """
+    Split the compacted user profiles of `history_file` between the history
+    segments {name: segment file}, `owner_of(user_id)` naming the owner.
+    Only the profiles are split, the per-user state a shard scores with;
+    dashboard counters and recent events are not per shard. Returns the
+    number of compacted users per segment.
+    """
+    counts = {}
+    if not os.path.exists(compacted_file(history_file)):
+        for name, segment in segments.items():
+            if os.path.exists(compacted_file(segment)):
+                os.remove(compacted_file(segment))
+            counts[name] = 0
+        return counts
+
+    archive = load_compacted(history_file)
+    user_ids = archive.profiles.user_ids()
+    owners = {uid: owner_of(uid) for uid in user_ids}
+    for name, segment in segments.items():
+        part = ScoringState()
+        counts[name] = part.profiles.merge(archive.profiles.export([u for u in user_ids if owners[u] == name]))
+        part.compacted_before = archive.compacted_before
+        part.save(compacted_file(segment))
+    return counts
+
+
+def export_compacted(history_file: str, user_ids) -> dict:
+    """
+    The compacted profiles of `user_ids` (UserProfiles.export), for handing
+    them to another shard along with their raw rows.
+    """
+    return load_compacted(history_file).profiles.export(user_ids)
+
+
+def import_compacted(history_file: str, user_ids, exported: dict):
+    """
+    Replace the compacted profiles of `user_ids` with `exported`, so a
+    repeated hand-over leaves the same state as a single one.
+    """
+    if not exported["user_ids"] and not os.path.exists(compacted_file(history_file)):
+        return
+    archive = load_compacted(history_file)
+    archive.profiles.drop(user_ids)
+    archive.profiles.merge(exported)
+    archive.save(compacted_file(history_file))
+
+
+def drop_compacted(history_file: str, user_ids) -> int:
+    """
+    Forget the compacted profiles of `user_ids`. Returns how many were held.
+    """
+    if not os.path.exists(compacted_file(history_file)):
+        return 0
+    archive = load_compacted(history_file)
+    dropped = archive.profiles.drop(user_ids)
+    if dropped:
+        archive.save(compacted_file(history_file))
+    return dropped
+
+
+def history_position(path: str = HISTORY_FILE):
+    """
+    Current end of the history file: byte offset, header line and the
+    bytes just before the offset. None if the file does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        header = f.readline()
+        offset = f.seek(0, os.SEEK_END)
+        f.seek(max(offset - FINGERPRINT_BYTES, 0))
+        tail = f.read(FINGERPRINT_BYTES)
+    return {"offset": offset, "header": header, "tail": tail}
+
+
+def position_valid(path: str, position) -> bool:
+    """
+    True if the file still starts with the same header and holds the same
+    bytes up to the position, i.e. it was only appended to since.
+    """
+    if position is None:
+        return not os.path.exists(path)
+    if not os.path.exists(path) or os.path.getsize(path) < position["offset"]:
+        return False
+    with open(path, "rb") as f:
+        if f.readline() != position["header"]:
+            return False
+        f.seek(position["offset"] - len(position["tail"]))
+        return f.read(len(position["tail"])) == position["tail"]
+
+
+def read_history_after(path: str, position) -> pd.DataFrame:
+    """
+    Rows appended after `position`, parsed with the file's header.
+    """
+    if not os.path.exists(path):
+        return pd.DataFrame()
+    header = pd.read_csv(path, nrows=0).columns.tolist()
+    with open(path, "rb") as f:
+        f.seek(position["offset"] if position else 0)
+        if not position:
+            f.readline()
+        try:
+            return pd.read_csv(f, header=None, names=header)
+        except pd.errors.EmptyDataError:
+            return pd.DataFrame(columns=header)
+
+
+def restore_state(history_file: str = HISTORY_FILE, snapshot_file: str = STATE_SNAPSHOT_FILE,
+                  capacity: int = RECENT_CAPACITY, per_user: int = RECENT_PER_USER,
+                  max_users: int = RECENT_USERS):
+    """
+    Load the snapshot and replay the history rows written after it, or
+    rebuild from the compacted state plus the full history file when there
+    is no usable snapshot. Returns
+    (state, info) where info has the source, replayed row count, history
+    size and elapsed seconds.
+    """
+    start = time.perf_counter()
+    state = None
+    if os.path.exists(snapshot_file):
+        try:
+            state = ScoringState.load(snapshot_file)
+        except Exception:
+            logger.exception("Could not load state snapshot %s, rebuilding from history", snapshot_file)
+        if state is not None and (
+            state.recent.config() != (capacity, per_user, max_users)
+            or not position_valid(history_file, state.position)
+        ):
+            state = None
+
+    if state is not None:
+        source = "snapshot"
+        replay = read_history_after(history_file, state.position)
+    else:
+        source = "history"
+        state = load_compacted(history_file, capacity, per_user, max_users)
+        if os.path.exists(history_file):
+            replay = pd.read_csv(history_file)
+        else:
+            replay = pd.DataFrame()
+    state.add_events(replay, history_position(history_file))
+
+    info = {
+        "source": source,
+        "replayed": len(replay),
+        "events": state.events,
+        "history_bytes": os.path.getsize(history_file) if os.path.exists(history_file) else 0,
+        "seconds": time.perf_counter() - start,
+    }
+    return state, info
+
+
+def bench(sizes, tail: int = 1000, sample_file: str = HISTORY_FILE, users: int = None):
+    """
+    For synthetic histories of each size: restart time from the full CSV
+    vs. from a snapshot plus `tail` rows appended after it, and the time
+    to save the snapshot. Events are spread over `users` users (default:
+    20 events per user).
+    """
+    sample = pd.read_csv(sample_file)
+    rng = np.random.default_rng(42)
+    tmp_dir = tempfile.mkdtemp(prefix="gart_state_bench_")
+    print(f"{'events':>10}{'history MB':>12}{'full s':>9}{'save s':>8}{'snapshot MB':>13}{'snapshot s':>12}"
+          f"{'replayed':>10}")
+    try:
+        for size in sizes:
+            rows = sample.iloc[rng.integers(0, len(sample), size + tail)].reset_index(drop=True)
+            rows["user_id"] = rng.integers(1, (users or max(size // 20, 1)) + 1, len(rows))
+            rows["timestamp"] = (pd.Timestamp.now().floor("s") - pd.to_timedelta(np.arange(len(rows))[::-1], unit="s")
+                                 ).strftime("%Y-%m-%d %H:%M:%S")
+            history_file = os.path.join(tmp_dir, f"history_{size}.csv")
+            snapshot_file = os.path.join(tmp_dir, f"state_{size}.pkl")
+            rows.iloc[:size].to_csv(history_file, index=False)
+
+            state, full = restore_state(history_file, snapshot_file)
+            start = time.perf_counter()
+            state.save(snapshot_file)
+            save_s = time.perf_counter() - start
+            rows.iloc[size:].to_csv(history_file, mode="a", header=False, index=False)
+            _, snap = restore_state(history_file, snapshot_file)
+            assert snap["source"] == "snapshot"
+
+            print(f"{size:>10}{snap['history_bytes'] / 2**20:>12.1f}{full['seconds']:>9.2f}{save_s:>8.2f}"
+                  f"{os.path.getsize(snapshot_file) / 2**20:>13.2f}{snap['seconds']:>12.2f}{snap['replayed']:>10}")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snapshot / restore the derived GART scoring state.")
+    parser.add_argument("command", choices=["snapshot", "bench"])
+    parser.add_argument("--history", default=HISTORY_FILE)
+    parser.add_argument("--snapshot", default=STATE_SNAPSHOT_FILE)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--tail", type=int, default=1000, help="rows appended after the snapshot in the benchmark")
+    parser.add_argument("--users", type=int, help="distinct users in the benchmark (default: 20 events per user)")
+    args = parser.parse_args()
+
+    if args.command == "snapshot":
+        state, info = restore_state(args.history, args.snapshot)
+        state.save(args.snapshot)
+        print(f"Saved state for {info['events']} events to {args.snapshot} "
+              f"({info['source']}, replayed {info['replayed']} rows in {info['seconds']:.2f}s)")
+    else:
+        bench(args.sizes, args.tail, args.history, args.users)
@@ -0,0 +1,383 @@
+"""
+Sharded scoring: users are partitioned across scoring_server.py processes
+by consistent hashing on user_id. Each shard holds its users' statistics
+in memory and persists their events to its own history segment. A thin router
+forwards /score to the owning shard. Adding or removing a shard only moves
+the users whose ring position changes owner.
+
+    python sharding.py partition --shards 4
+    python sharding.py cluster --shards 4 --port 8600
+    python loadtest.py --url http://127.0.0.1:8600 --concurrency 32 --duration 30
+    curl -X POST localhost:8600/shards -d '{"name": "s4", "url": "http://127.0.0.1:8605"}'
+"""
+import argparse
+import bisect
+import hashlib
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import pandas as pd
+
+from scoring import HISTORY_COLS
+from scoring_server import HISTORY_FILE, ScoringClient, ScoringHandler
+from scoring_state import split_compacted
+
+
+logger = logging.getLogger(__name__)
+
+VNODES = 512
+
+
+def _point(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent-hash ring. Each shard owns `vnodes` points, so users spread
+    evenly and a new shard takes about 1/N of the users from every other shard.
+    """
+
+    def __init__(self, shards=(), vnodes: int = VNODES):
+        self.vnodes = vnodes
+        self.shards = []
+        self._points = []
+        self._owners = []
+        for shard in shards:
+            self.add(shard)
+
+    def add(self, shard: str):
+        if shard in self.shards:
+            return
+        self.shards.append(shard)
+        for i in range(self.vnodes):
+            point = _point(f"{shard}#{i}")
+            idx = bisect.bisect(self._points, point)
+            self._points.insert(idx, point)
+            self._owners.insert(idx, shard)
+
+    def remove(self, shard: str):
+        self.shards.remove(shard)
+        keep = [i for i, owner in enumerate(self._owners) if owner != shard]
+        self._points = [self._points[i] for i in keep]
+        self._owners = [self._owners[i] for i in keep]
+
+    def copy(self) -> "HashRing":
+        ring = HashRing(vnodes=self.vnodes)
+        ring.shards = list(self.shards)
+        ring._points = list(self._points)
+        ring._owners = list(self._owners)
+        return ring
+
+    def shard_for(self, user_id) -> str:
+        if not self._points:
+            raise ValueError("hash ring has no shards")
+        idx = bisect.bisect(self._points, _point(str(int(user_id)))) % len(self._points)
+        return self._owners[idx]
+
+
+def segment_file(name: str, history_file: str = HISTORY_FILE) -> str:
+    root, ext = os.path.splitext(history_file)
+    return f"{root}.shard-{name}{ext}"
+
+
+def shard_names(n: int) -> list:
+    return [f"s{i}" for i in range(n)]
+
+
+def partition_history(names, history_file: str = HISTORY_FILE, vnodes: int = VNODES) -> dict:
+    """
+    Split the history into one segment per shard, and the profiles compacted
+    out of it into each segment's compacted file. Returns rows per shard.
+    """
+    ring = HashRing(names, vnodes)
+    history = pd.read_csv(history_file) if os.path.exists(history_file) else pd.DataFrame(columns=HISTORY_COLS)
+    owner = history["user_id"].map(ring.shard_for).astype(object)
+    counts = {}
+    for name in names:
+        rows = history[owner == name]
+        rows.to_csv(segment_file(name, history_file), index=False)
+        counts[name] = len(rows)
+    split_compacted(history_file, {name: segment_file(name, history_file) for name in names}, ring.shard_for)
+    return counts
+
+
+class ShardRouter:
+    """
+    Forwards scoring requests to the shard that owns the user.
+
+    While shards are added or removed, new requests wait and in-flight ones
+    finish, so no user is scored on two shards. The moved users are copied
+    to their new shard, the ring is switched, and only then are they
+    dropped from the old shard. If copying fails, the copies already made
+    are dropped from the new shards and the ring is left as it was; the
+    copy can simply be retried, since importing replaces a user's data.
+    """
+
+    def __init__(self, shards: dict, vnodes: int = VNODES):
+        self.ring = HashRing(shards, vnodes)
+        self.clients = {name: ScoringClient(url) for name, url in shards.items()}
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._paused = False
+        self._rebalance_lock = threading.Lock()
+        self.last_rebalance = None
+
+    def score(self, request: dict) -> dict:
+        with self._cond:
+            while self._paused:
+                self._cond.wait()
+            shard = self.ring.shard_for(request["user_id"])
+            client = self.clients[shard]
+            self._in_flight += 1
+        try:
+            return {**client.score(request), "shard": shard}
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                if self._in_flight == 0:
+                    self._cond.notify_all()
+
+    def health(self) -> dict:
+        shards = {}
+        for name, client in self.clients.items():
+            try:
+                shards[name] = {"url": client.url, **client.call("GET", "/health")}
+            except Exception as e:
+                shards[name] = {"url": client.url, "status": "down", "error": str(e)}
+        ok = all(s["status"] == "ok" for s in shards.values())
+        return {"status": "ok" if ok else "degraded", "shards": shards, "last_rebalance": self.last_rebalance}
+
+    def add_shard(self, name: str, url: str) -> dict:
+        new_ring = self.ring.copy()
+        new_ring.add(name)
+        return self._rebalance(new_ring, {name: ScoringClient(url)})
+
+    def remove_shard(self, name: str) -> dict:
+        new_ring = self.ring.copy()
+        new_ring.remove(name)
+        return self._rebalance(new_ring, {})
+
+    def _rebalance(self, new_ring: HashRing, new_clients: dict) -> dict:
+        with self._rebalance_lock:
+            start = time.perf_counter()
+            with self._cond:
+                self._paused = True
+                while self._in_flight:
+                    self._cond.wait()
+            try:
+                clients = {**self.clients, **new_clients}
+                moves = {}
+                total = 0
+                for name in self.ring.shards:
+                    user_ids = clients[name].call("GET", "/users")["user_ids"]
+                    total += len(user_ids)
+                    for uid in user_ids:
+                        target = new_ring.shard_for(uid)
+                        if target != name:
+                            moves.setdefault((name, target), []).append(uid)
+
+                copied = []
+                try:
+                    for (source, target), user_ids in moves.items():
+                        copied.append((target, user_ids))
+                        exported = clients[source].call("POST", "/export_users", {"user_ids": user_ids})
+                        clients[target].call("POST", "/import_users", exported)
+                except Exception:
+                    self._undo_copies(clients, copied)
+                    raise
+
+                self.ring = new_ring
+                self.clients = {name: clients[name] for name in new_ring.shards}
+                # The new ring is live; a source that fails to drop only keeps a
+                # stale copy that is no longer routed to.
+                not_dropped = {}
+                for (source, _), user_ids in moves.items():
+                    try:
+                        clients[source].call("POST", "/drop_users", {"user_ids": user_ids})
+                    except Exception as e:
+                        logger.error("Shard %s kept %d moved users: %s", source, len(user_ids), e)
+                        not_dropped[source] = not_dropped.get(source, 0) + len(user_ids)
+            finally:
+                with self._cond:
+                    self._paused = False
+                    self._cond.notify_all()
+
+            moved = sum(len(ids) for ids in moves.values())
+            self.last_rebalance = {
+                "shards": list(new_ring.shards),
+                "users": total,
+                "moved_users": moved,
+                "moved_pct": moved / total * 100 if total else 0.0,
+                "moves": {f"{s}->{t}": len(ids) for (s, t), ids in moves.items()},
+                "not_dropped": not_dropped,
+                "paused_ms": (time.perf_counter() - start) * 1000,
+            }
+            return self.last_rebalance
+
+    def _undo_copies(self, clients: dict, copied):
+        # Best effort: the shard that failed may not answer this either.
+        for target, user_ids in copied:
+            try:
+                clients[target].call("POST", "/drop_users", {"user_ids": user_ids})
+            except Exception as e:
+                logger.error("Could not roll back %d users copied to shard %s: %s", len(user_ids), target, e)
+
+
+class RouterHandler(ScoringHandler):
+    """
+    POST /score forwards to the owning shard, GET /health reports every
+    shard, POST /shards {"name", "url"} adds a shard and
+    DELETE /shards/<name> removes one (both rebalance users).
+    """
+
+    router = None
+
+    def do_POST(self):
+        try:
+            body = self._read_json()
+            if self.path == "/score":
+                result = self.router.score(body)
+            elif self.path == "/shards":
+                result = self.router.add_shard(body["name"], body["url"])
+            else:
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+                return
+        except (KeyError, ValueError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self._send_json(502, {"error": str(e)})
+            return
+        self._send_json(200, result)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        self._send_json(200, self.router.health())
+
+    def do_DELETE(self):
+        if not self.path.startswith("/shards/"):
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            result = self.router.remove_shard(self.path[len("/shards/"):])
+        except (KeyError, ValueError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self._send_json(502, {"error": str(e)})
+            return
+        self._send_json(200, result)
+
+
+def make_router_server(router: ShardRouter, host: str = "127.0.0.1", port: int = 8600) -> ThreadingHTTPServer:
+    handler = type("BoundRouterHandler", (RouterHandler,), {"router": router})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+class LocalCluster:
+    """
+    Runs each shard as a local scoring_server.py process with --persist on
+    its own history segment, for testing the sharded mode on one machine.
+    """
+
+    def __init__(self, history_file: str = HISTORY_FILE, host: str = "127.0.0.1", extra_args=()):
+        self.history_file = history_file
+        self.host = host
+        self.extra_args = list(extra_args)
+        self.processes = {}
+
+    def start_shard(self, name: str, port: int, timeout: float = 60.0) -> str:
+        url = f"http://{self.host}:{port}"
+        self.processes[name] = subprocess.Popen([
+            sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scoring_server.py"),
+            "--host", self.host, "--port", str(port), "--persist",
+            "--history", segment_file(name, self.history_file), *self.extra_args,
+        ])
+        client = ScoringClient(url, timeout=2)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                client.call("GET", "/health")
+                return url
+            except Exception:
+                if self.processes[name].poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"shard {name} did not start on {url}")
+                time.sleep(0.2)
+
+    def stop(self):
+        # SIGINT lets scoring_server.py flush its history writer.
+        for proc in self.processes.values():
+            proc.send_signal(signal.SIGINT)
+        for proc in self.processes.values():
+            try:
+                proc.wait(15)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        self.processes = {}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run GART scoring sharded by user_id.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("partition", help="split the history into per-shard segments")
+    p.add_argument("--shards", type=int, default=4)
+    p.add_argument("--history", default=HISTORY_FILE)
+
+    p = sub.add_parser("router", help="route to already running shards")
+    p.add_argument("--shard", action="append", required=True, metavar="NAME=URL")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8600)
+
+    p = sub.add_parser("cluster", help="start N local shard processes plus the router")
+    p.add_argument("--shards", type=int, default=4)
+    p.add_argument("--history", default=HISTORY_FILE)
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8600, help="router port; shards use the following ports")
+    p.add_argument("--repartition", action="store_true", help="re-split the history even if segments exist")
+    args = parser.parse_args()
+
+    if args.command == "partition":
+        counts = partition_history(shard_names(args.shards), args.history)
+        for name, n in counts.items():
+            print(f"{name}: {n} events -> {segment_file(name, args.history)}")
+        sys.exit(0)
+
+    cluster = None
+    if args.command == "router":
+        shards = dict(s.split("=", 1) for s in args.shard)
+    else:
+        names = shard_names(args.shards)
+        if args.repartition or not all(os.path.exists(segment_file(n, args.history)) for n in names):
+            partition_history(names, args.history)
+        cluster = LocalCluster(args.history, args.host)
+        shards = {}
+        try:
+            for i, name in enumerate(names, 1):
+                shards[name] = cluster.start_shard(name, args.port + i)
+                print(f"Shard {name} on {shards[name]}")
+        except Exception:
+            cluster.stop()
+            raise
+
+    server = make_router_server(ShardRouter(shards), args.host, args.port)
+    print(f"Routing on http://{args.host}:{args.port}/score")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if cluster is not None:
+            cluster.stop()
@@ -0,0 +1,116 @@
+import os
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.utils.class_weight import compute_class_weight
+
+from feedback import FEEDBACK_FILE, FEATURE_COLS, load_feedback
+from mapped_model import MAPPED_MODEL_DIR, export_model
+
+
+MODEL_FILE = "gart_model.pkl"
+TRAINING_FILE = "gart_data.csv"
+REPLAY_FILE = "gart_replay_buffer.pkl"
+
+NEW_TREES = 10
+MAX_TREES = 300
+
+# Trees of the original fit (full training set) are never evicted; only the
+# incremental ones are, so at most MAX_TREES minus those come from the buffer.
+BASE_TREES_ATTR = "gart_base_trees_"
+
+# Bounded replay buffer of labelled events the new trees are fitted on.
+REPLAY_SIZE = 5000
+
+# A fresh buffer is seeded with this many original training rows, so new
+# trees still see both classes and the old distribution.
+SEED_SIZE = 500
+
+
+def load_replay_state(path: str = REPLAY_FILE, training_file: str = TRAINING_FILE) -> dict:
+    """
+    Returns {"buffer": DataFrame of FEATURE_COLS + label, "feedback_rows": int}
+    where feedback_rows is how many feedback rows were already consumed.
+    """
+    if os.path.exists(path):
+        return joblib.load(path)
+
+    buffer = pd.DataFrame(columns=FEATURE_COLS + ["label"])
+    if os.path.exists(training_file):
+        training = pd.read_csv(training_file)
+        buffer = training.sample(n=min(SEED_SIZE, len(training)), random_state=42)[FEATURE_COLS + ["label"]]
+    return {"buffer": buffer.reset_index(drop=True), "feedback_rows": 0}
+
+
+def update_model(model, buffer: pd.DataFrame, new_trees: int = NEW_TREES, max_trees: int = MAX_TREES):
+    """
+    Grow the forest by `new_trees` trees fitted on the replay buffer only.
+    The fitted preprocessing and the existing trees are left untouched; once
+    the forest exceeds `max_trees` the oldest incremental trees are dropped.
+    The original trees are pinned.
+    """
+    preprocess = model.named_steps["preprocess"]
+    clf = model.named_steps["clf"]
+    if not hasattr(clf, BASE_TREES_ATTR):
+        setattr(clf, BASE_TREES_ATTR, len(clf.estimators_))
+    base = getattr(clf, BASE_TREES_ATTR)
+
+    Xt = preprocess.transform(buffer[FEATURE_COLS])
+    y = buffer["label"].astype(int)
+
+    # "balanced" is resolved against the buffer explicitly; sklearn refuses
+    # to guess it for warm-started fits on partial data.
+    classes = np.unique(y)
+    weights = compute_class_weight("balanced", classes=classes, y=y)
+    clf.set_params(
+        warm_start=True,
+        n_estimators=len(clf.estimators_) + new_trees,
+        class_weight=dict(zip(classes.tolist(), weights)),
+    )
+    clf.fit(Xt, y)
+
+    if len(clf.estimators_) > max_trees:
+        keep = max(max_trees - base, new_trees)
+        clf.estimators_ = clf.estimators_[:base] + clf.estimators_[-keep:]
+        clf.set_params(n_estimators=len(clf.estimators_))
+    return model
+
+
+def publish_model(model, path: str = MODEL_FILE):
+    """
+    Write the model next to `path` and swap it in atomically, so a scorer
+    loading it never sees a half-written file.
+    """
+    tmp_path = path + ".tmp"
+    joblib.dump(model, tmp_path)
+    os.replace(tmp_path, path)
+
+    # Keep the memory-mapped copy in step if this host uses one.
+    if os.path.isdir(MAPPED_MODEL_DIR):
+        export_model(model, MAPPED_MODEL_DIR, source_mtime=os.path.getmtime(path))
+
+
+if __name__ == "__main__":
+    state = load_replay_state(REPLAY_FILE)
+    new_events = load_feedback(FEEDBACK_FILE, start=state["feedback_rows"])
+
+    if new_events.empty:
+        print("No new labelled events – model unchanged.")
+    else:
+        buffer = pd.concat(
+            [state["buffer"], new_events[FEATURE_COLS + ["label"]]], ignore_index=True
+        ).tail(REPLAY_SIZE).reset_index(drop=True)
+
+        if buffer["label"].nunique() < 2:
+            print("Replay buffer has a single class – waiting for more labels.")
+        else:
+            model = update_model(joblib.load(MODEL_FILE), buffer)
+            publish_model(model, MODEL_FILE)
+
+            state = {"buffer": buffer, "feedback_rows": state["feedback_rows"] + len(new_events)}
+            joblib.dump(state, REPLAY_FILE)
+
+            n_trees = len(model.named_steps["clf"].estimators_)
+            print(f"Added {NEW_TREES} trees from {len(new_events)} new labels "
+                  f"(buffer {len(buffer)}, forest {n_trees} trees). Saved to {MODEL_FILE}")